@@ -0,0 +1,112 @@
+# fund.py 离线压测: 本地行情替身 + 内存表格，用 Streamlit AppTest 跑整页
+# 用法: python bench/bench_fund.py --sizes 10 100 1000 --latency 0.05 --fail-rate 0.02 --out bench_results.json
+#       加 --backend sqlite 对比本地存储后端，加 --shared sqlite/redis 打开共享缓存 (redis 用内存替身)
+# 每个规模在独立子进程里跑，缓存和后台线程互不干扰；结果写成 JSON，方便前后两次对比
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FUND_PY = os.path.join(os.path.dirname(HERE), "fund.py")
+PROXY_POOL = ["sh510300", "sh510500", "sz159915", "sh512880", "sh513100", "sz159919", "sh510050", "sh512100"]
+
+def make_tabs(n):
+    portfolio = [["code", "name", "shares", "avg_cost", "proxy_code", "txn_seq"]]
+    for i in range(n):
+        portfolio.append([f"{i:06d}", f"基金{i}", "1000", "1.2", PROXY_POOL[i % len(PROXY_POOL)], "0"])
+    sip = [["fund_code", "daily_amount", "last_run_date", "status"]]
+    for i in range(0, n, 10):
+        sip.append([f"{i:06d}", "100", "2026-09-28", "ON"])
+    txn = [["date", "code", "amount", "nav", "shares", "source"]]
+    return {"Fund_Portfolio": portfolio, "SIP_Config": sip, "Transactions": txn}
+
+def run_one(n, args):
+    sys.path.insert(0, HERE)
+    from stand_ins import QuoteServer, FakeSpreadsheet, install_fake_sheets, install_fake_redis
+    from streamlit.testing.v1 import AppTest
+
+    server = QuoteServer(latency=args.latency, fail_rate=args.fail_rate).start()
+    os.environ["HTTP_PROXY"] = os.environ["http_proxy"] = server.url
+    os.environ.pop("NO_PROXY", None)
+    os.environ.pop("no_proxy", None)
+    sheet = FakeSpreadsheet(make_tabs(n))
+    install_fake_sheets(sheet)
+    if args.shared == "redis": install_fake_redis()
+
+    runs = []
+    for i in range(1 + args.reruns):
+        at = AppTest.from_file(FUND_PY, default_timeout=args.timeout)
+        at.secrets["gcp_service_account"] = {"type": "service_account"}
+        if args.backend == "sqlite": at.secrets["storage"] = {"backend": "sqlite", "path": "bench_data.db"} # 首次运行从内存表格导入
+        if args.shared == "sqlite": at.secrets["shared_cache"] = {"backend": "sqlite", "path": "bench_shared.db"}
+        if args.shared == "redis": at.secrets["shared_cache"] = {"backend": "redis", "url": "redis://stand-in/0"}
+        at.session_state["auth"] = True
+        http_before, sheet_before = sum(server.calls.values()), sum(sheet.calls.values())
+        t0 = time.perf_counter()
+        at.run()
+        runs.append({
+            "latency_s": round(time.perf_counter() - t0, 4),
+            "http_calls": sum(server.calls.values()) - http_before,
+            "sheet_calls": sum(sheet.calls.values()) - sheet_before,
+            "errors": [str(e.value) for e in at.exception],
+        })
+    server.stop()
+    warm = runs[1:] or runs
+    return {
+        "funds": n,
+        "cold": runs[0],
+        "warm_latency_s": round(sum(r["latency_s"] for r in warm) / len(warm), 4),
+        "warm_http_calls": max(r["http_calls"] for r in warm),
+        "warm_sheet_calls": max(r["sheet_calls"] for r in warm),
+        "http_by_host": dict(server.calls),
+        "sheet_by_call": dict(sheet.calls),
+        "runs": runs,
+    }
+
+def main():
+    p = argparse.ArgumentParser(description="fund.py 离线压测")
+    p.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    p.add_argument("--latency", type=float, default=0.05, help="行情替身每个请求的延迟 (秒)")
+    p.add_argument("--fail-rate", type=float, default=0.0, help="行情替身返回 500 的比例")
+    p.add_argument("--backend", choices=["sheets", "sqlite"], default="sheets", help="存储后端")
+    p.add_argument("--shared", choices=["none", "sqlite", "redis"], default="none", help="多副本共享缓存")
+    p.add_argument("--reruns", type=int, default=3, help="冷启动之后再跑几次热 rerun")
+    p.add_argument("--timeout", type=float, default=300)
+    p.add_argument("--out", default="bench_results.json")
+    p.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = p.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(run_one(args.child, args), ensure_ascii=False))
+        return
+
+    results = []
+    for n in args.sizes:
+        # 每个规模一个全新的进程 + 临时工作目录 (净值缓存/历史库都落在工作目录下)
+        with tempfile.TemporaryDirectory() as cwd:
+            cmd = [sys.executable, os.path.abspath(__file__), "--child", str(n)] + sys.argv[1:]
+            out = subprocess.run(cmd, cwd=cwd, capture_output=True, text=True)
+        if out.returncode != 0:
+            results.append({"funds": n, "error": out.stderr[-2000:]})
+            print(f"{n:>5} 只基金: 失败")
+            continue
+        r = json.loads(out.stdout.strip().splitlines()[-1])
+        results.append(r)
+        print(f"{n:>5} 只基金: 冷启动 {r['cold']['latency_s']:.3f}s (HTTP {r['cold']['http_calls']}, 表格 {r['cold']['sheet_calls']}) | "
+              f"热 rerun {r['warm_latency_s']:.3f}s (HTTP {r['warm_http_calls']}, 表格 {r['warm_sheet_calls']})")
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "config": {"latency": args.latency, "fail_rate": args.fail_rate, "reruns": args.reruns, "backend": args.backend, "shared": args.shared},
+        "results": results,
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入 {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+# 压测用的本地替身: 行情 HTTP 服务 + 内存版 gspread 表格 + 内存版 Redis
+# 行情服务以 HTTP 代理的方式运行，设置 HTTP_PROXY 后 fund.py 里写死的 URL 原样发给它，不用改业务代码
+import json
+import random
+import re
+import sys
+import threading
+import time
+import types
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import gspread
+import numpy as np
+
+# ================= 1. 行情替身 =================
+class QuoteServer:
+    def __init__(self, latency=0.0, fail_rate=0.0, jzrq="2026-10-16", seed=0):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.jzrq = jzrq
+        self.rand = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter() # host -> 请求次数
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args): pass
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                with server.lock:
+                    server.calls[url.hostname] += 1
+                    fail = server.rand.random() < server.fail_rate
+                time.sleep(server.latency)
+                if fail: return self._reply(500, b"")
+                code, body = server.respond(url)
+                self._reply(code, body)
+
+            def _reply(self, code, body):
+                self.send_response(code)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+
+    def respond(self, url):
+        m = re.match(r"/js/(\d+)\.js", url.path)
+        if url.hostname == "fundgz.1234567.com.cn" and m:
+            code = m.group(1)
+            data = {"fundcode": code, "name": f"基金{code}", "jzrq": self.jzrq, "dwjz": "1.5000", "gsz": "1.5100"}
+            return 200, f"jsonpgz({json.dumps(data, ensure_ascii=False)});".encode("utf-8")
+        if url.hostname == "hq.sinajs.cn":
+            syms = (url.path + "?" + url.query).split("list=", 1)[-1].split("?")[0].split(",")
+            lines = [f'var hq_str_{s}="ETF{s},2.000,2.000,2.020,2.030,1.990";' for s in syms if s]
+            return 200, "\n".join(lines).encode("gbk")
+        if url.hostname == "api.fund.eastmoney.com":
+            q = {k: v[0] for k, v in parse_qs(url.query).items()}
+            days = np.arange(np.datetime64(q["startDate"]), np.datetime64(q["endDate"]) + 1)
+            days = [str(d) for d in days[np.is_busday(days)]][::-1]
+            size, page = int(q["pageSize"]), int(q["pageIndex"])
+            items = [{"FSRQ": d, "DWJZ": "1.5000"} for d in days[(page - 1) * size: page * size]]
+            return 200, json.dumps({"Data": {"LSJZList": items}, "TotalCount": len(days)}).encode()
+        return 404, b""
+
+# ================= 2. 表格替身 =================
+class _Response:
+    def __init__(self, message):
+        self.text = message
+        self.status_code = 400
+    def json(self):
+        return {"error": {"code": 400, "message": self.text, "status": "INVALID_ARGUMENT"}}
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, title, rows=None):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = len(spreadsheet.tabs) + 1
+        self.rows = [list(map(str, r)) for r in (rows or [])]
+
+    def _count(self, name):
+        self.spreadsheet.calls[name] += 1
+
+    def get_all_values(self):
+        self._count("get_all_values")
+        return gspread.utils.fill_gaps([list(r) for r in self.rows]) if self.rows else []
+
+    def clear(self):
+        self._count("clear")
+        self.rows = []
+
+    def _write(self, r, c, values):
+        for i, row in enumerate(values):
+            while len(self.rows) < r + i: self.rows.append([])
+            target = self.rows[r + i - 1]
+            for j, v in enumerate(row):
+                while len(target) < c + j: target.append("")
+                target[c + j - 1] = str(v)
+
+    def update(self, values, range_name="A1", **kwargs):
+        self._count("update")
+        r, c = gspread.utils.a1_to_rowcol(range_name.split(":")[0])
+        self._write(r, c, values)
+
+    def batch_update(self, data, **kwargs):
+        self._count("batch_update")
+        for d in data:
+            r, c = gspread.utils.a1_to_rowcol(d["range"].split(":")[0])
+            self._write(r, c, d["values"])
+
+    # 和表格一样接在检测到的表尾 (从第一行往下到第一个整行空白为止) 后面写，返回里带实际写到的范围
+    def append_rows(self, values, **kwargs):
+        self._count("append_rows")
+        rows = [list(map(str, r)) for r in values]
+        n = next((i for i, r in enumerate(self.rows) if not any(r)), len(self.rows))
+        self.rows[n:n + len(rows)] = rows
+        end = gspread.utils.rowcol_to_a1(n + len(rows), max(map(len, rows), default=1))
+        return {"updates": {"updatedRange": f"'{self.title}'!A{n + 1}:{end}", "updatedRows": len(rows)}}
+
+    def row_values(self, row, **kwargs):
+        self._count("row_values")
+        return list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+    def append_row(self, values, **kwargs):
+        self._count("append_row")
+        self.rows.append(list(map(str, values)))
+
+    def delete_rows(self, start, end=None):
+        self._count("delete_rows")
+        del self.rows[start - 1:(end or start)]
+
+class FakeSpreadsheet:
+    def __init__(self, tabs=None):
+        self.calls = Counter()
+        self.tabs = {}
+        for title, rows in (tabs or {}).items():
+            self.tabs[title] = FakeWorksheet(self, title, rows)
+
+    def worksheet(self, title):
+        self.calls["worksheet"] += 1
+        if title not in self.tabs: raise gspread.exceptions.WorksheetNotFound(title)
+        return self.tabs[title]
+
+    def worksheets(self):
+        self.calls["worksheets"] += 1
+        return list(self.tabs.values())
+
+    def add_worksheet(self, title, rows=100, cols=20, **kwargs):
+        self.calls["add_worksheet"] += 1
+        self.tabs[title] = FakeWorksheet(self, title)
+        return self.tabs[title]
+
+    def del_worksheet(self, ws):
+        self.calls["del_worksheet"] += 1
+        self.tabs.pop(ws.title, None)
+
+    def values_batch_get(self, ranges, params=None):
+        self.calls["values_batch_get"] += 1
+        names = [r.split("!")[0].strip("'") for r in ranges]
+        missing = [n for n in names if n not in self.tabs]
+        if missing: raise gspread.exceptions.APIError(_Response(f"Unable to parse range: {missing[0]}"))
+        major = (params or {}).get("majorDimension", "ROWS")
+        out = []
+        for r, n in zip(ranges, names):
+            vals = _values(self.tabs[n].rows, r.split("!")[1] if "!" in r else "", major)
+            out.append({"range": r, "majorDimension": major, **({"values": vals} if vals else {})})
+        return {"valueRanges": out}
+
+    def batch_update(self, body):
+        self.calls["batch_update"] += 1
+        by_id = {ws.id: ws for ws in self.tabs.values()}
+        for req in body.get("requests", []):
+            rng = req["deleteDimension"]["range"]
+            del by_id[rng["sheetId"]].rows[rng["startIndex"]:rng["endIndex"]]
+
+# 按 A1 范围 (整列 A:B、单格 A1、区间 A2:C9，空串是整张表) 取值，majorDimension 为 COLUMNS 时按列返回
+# 和表格一样去掉末尾的空格子和空行，整个范围都是空的就没有 values
+def _values(rows, a1, major):
+    rows = [list(r) for r in rows]
+    if a1:
+        m = re.fullmatch(r"([A-Z]+)(\d*)(?::([A-Z]+)(\d*))?", a1)
+        col = lambda letters: gspread.utils.a1_to_rowcol(letters + "1")[1]
+        c0, c1 = col(m[1]), col(m[3] or m[1])
+        r0 = int(m[2] or 1)
+        r1 = int(m[4]) if m[4] else (r0 if m[2] and not m[3] else len(rows))
+        rows = [r[c0 - 1:c1] for r in rows[r0 - 1:r1]]
+    if major == "COLUMNS":
+        width = max(map(len, rows), default=0)
+        rows = [[r[c] if c < len(r) else "" for r in rows] for c in range(width)]
+    rows = [r[:max((i + 1 for i, v in enumerate(r) if v != ""), default=0)] for r in rows]
+    while rows and not rows[-1]: rows.pop()
+    return rows
+
+# 让 get_db_connection() 拿到内存表格: 替换 gspread.authorize 和凭证解析
+def install_fake_sheets(spreadsheet):
+    from oauth2client.service_account import ServiceAccountCredentials
+    gspread.authorize = lambda creds: types.SimpleNamespace(open=lambda name: spreadsheet)
+    ServiceAccountCredentials.from_json_keyfile_dict = classmethod(lambda cls, keyfile_dict, scopes=None: None)
+
+# ================= 3. Redis 替身 =================
+# 进程内的 Redis 子集 (共享缓存用到的命令)，同一个 url 拿到同一份数据
+class MemoryRedis:
+    servers = {}
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.data = {} # key -> (value, 过期时间)
+        self.hashes = {}
+        self.messages = [] # [(channel, data)]，订阅者各自记读到第几条
+        self.calls = Counter()
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        return cls.servers.setdefault(url, cls())
+
+    @staticmethod
+    def _b(v):
+        return v if isinstance(v, bytes) else str(v).encode("utf-8")
+
+    def get(self, key):
+        with self.lock:
+            self.calls["get"] += 1
+            v = self.data.get(key)
+            if v is None or (v[1] and v[1] < time.time()): return None
+            return v[0]
+
+    def set(self, key, value, ex=None, get=False):
+        with self.lock:
+            self.calls["set"] += 1
+            old = self.data.get(key)
+            self.data[key] = (self._b(value), time.time() + ex if ex else None)
+            return old[0] if get and old else None
+
+    def hgetall(self, name):
+        with self.lock:
+            self.calls["hgetall"] += 1
+            return {self._b(k): self._b(v) for k, v in self.hashes.get(name, {}).items()}
+
+    def hincrby(self, name, key, amount=1):
+        with self.lock:
+            self.calls["hincrby"] += 1
+            h = self.hashes.setdefault(name, {})
+            h[key] = h.get(key, 0) + amount
+            return h[key]
+
+    def publish(self, channel, data):
+        with self.lock:
+            self.calls["publish"] += 1
+            self.messages.append((channel, self._b(data)))
+            self.lock.notify_all()
+            return 1
+
+    def pipeline(self):
+        return _Pipeline(self)
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return _PubSub(self)
+
+class _Pipeline:
+    def __init__(self, r):
+        self.r = r
+        self.ops = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.ops.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        ops, self.ops = self.ops, []
+        return [getattr(self.r, name)(*args, **kwargs) for name, args, kwargs in ops]
+
+class _PubSub:
+    def __init__(self, r):
+        self.r = r
+        self.channels = set()
+        self.pos = 0
+
+    def subscribe(self, *channels):
+        with self.r.lock:
+            self.channels.update(channels)
+            self.pos = len(self.r.messages)
+
+    def listen(self):
+        while True:
+            with self.r.lock:
+                while self.pos >= len(self.r.messages): self.r.lock.wait()
+                channel, data = self.r.messages[self.pos]
+                self.pos += 1
+            if channel in self.channels: yield {"type": "message", "channel": channel.encode("utf-8"), "data": data}
+
+# 让共享缓存的 redis 后端拿到内存版: 注册一个假的 redis 模块
+def install_fake_redis():
+    sys.modules["redis"] = types.SimpleNamespace(Redis=MemoryRedis)
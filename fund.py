@@ -1,5 +1,6 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta, date
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
@@ -7,12 +8,47 @@ import time
 import requests
 import json
 import re
+import os
+import threading
+from collections import OrderedDict, deque
+from types import MappingProxyType
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed
+from requests.adapters import HTTPAdapter
+from nav_history import NavHistory
+from trade_calendar import last_trading_day, count_trading_days, trading_days_between, is_trading_session
+from sheet_store import start_perf, start_fragment_perf, perf, render_perf_panel, open_store, open_shared_cache, read_through
 
 # ================= 1. 核心配置 =================
 SCOPE = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
 SHEET_NAME = "Team_Data_Center" 
 TAB_PORTFOLIO = "Fund_Portfolio" 
 TAB_SIP = "SIP_Config" # 新增：存放定投配置
+TAB_TXN = "Transactions" # 买入流水 (只追加)
+PORTFOLIO_COLS = ["code", "name", "shares", "avg_cost", "proxy_code", "txn_seq"]
+SIP_COLS = ["fund_code", "daily_amount", "last_run_date", "status"] # status: ON/OFF
+TXN_COLS = ["date", "code", "amount", "nav", "shares", "source"]
+LEDGER_COMPACT_EVERY = 20 # 未压缩的流水攒到这么多条，就把持仓快照写回持仓表
+QUOTE_WORKERS = 16 # 行情并发请求上限
+SINA_URL_MAX = 1800 # 新浪批量行情单个 URL 的长度上限
+NAV_TTL = 60 # 当日净值未出时，隔多少秒重新查一次
+NAV_FAIL_TTL = 30 # 查询失败的代码，隔多少秒再试
+NAV_CACHE_SIZE = 512 # 内存里最多缓存多少只基金
+NAV_CACHE_DIR = ".nav_cache" # 净值落盘目录，设为 None 则只用内存
+NAV_DB_PATH = "nav_history.db" # 本地历史净值库
+QUOTE_REFRESH_SECONDS = 30 # 盘中后台刷新行情的间隔
+QUOTE_IDLE_SECONDS = 600 # 非交易时段的刷新间隔 (等晚上的官方净值)
+PERF_APP = "fund" # 性能埋点里的应用名
+QUOTE_TIMEOUT_MIN = 0.3 # 自适应超时的下限 (秒)
+QUOTE_TIMEOUT_MAX = 2.0 # 自适应超时的上限，样本不够时也用它
+BREAKER_FAILS = 5 # 连续失败多少次熔断
+BREAKER_COOLDOWN = 30 # 熔断多少秒后放一个探测请求
+STORE_DB_PATH = "fund_data.db" # 本地存储后端 (secrets 里 storage.backend = "sqlite" 时启用) 的默认路径
+STORE_INDEXES = {TAB_PORTFOLIO: ["code"], TAB_SIP: ["fund_code"], TAB_TXN: ["code"]}
+MIRROR_SECONDS = 60 # 本地库镜像回谷歌表格的间隔
+SHARED_DB_PATH = "fund_shared.db" # 多副本共享缓存 (secrets 里 shared_cache.backend = "sqlite" 时) 的默认路径
+SHARED_TTL = 30 # 共享缓存条目最长用多久 (直接在表格里改的内容最多晚这么久看到)
+SHARED_POLL = 1 # 共享缓存监听失效消息的间隔 (sqlite)、断线重连的间隔 (redis)
 
 def get_beijing_time():
     utc = datetime.utcnow()
@@ -22,92 +58,601 @@ def get_beijing_time():
 def get_today_str():
     return get_beijing_time()[0]
 
+# ================= 性能埋点 =================
+PERF = start_perf(PERF_APP)
+
 # ================= 2. 谷歌连接 & 数据接口 =================
 @st.cache_resource
 def get_db_connection():
     try:
-        creds_dict = dict(st.secrets["gcp_service_account"])
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, SCOPE)
-        client = gspread.authorize(creds)
-        sheet = client.open(SHEET_NAME)
+        with perf("sheets", "connect", SHEET_NAME):
+            creds_dict = dict(st.secrets["gcp_service_account"])
+            creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, SCOPE)
+            client = gspread.authorize(creds)
+            sheet = client.open(SHEET_NAME)
         return sheet
     except Exception as e: return None
 
-# 加载数据 (同时加载持仓表和定投表)
+# ================= 存储后端 =================
+# 持仓、定投、流水三张表，secrets 里没配 [storage] 时直接读写谷歌表格
+@st.cache_resource(show_spinner=False)
+def get_store():
+    return open_store(get_db_connection, STORE_DB_PATH, STORE_INDEXES, [TAB_PORTFOLIO, TAB_SIP, TAB_TXN], MIRROR_SECONDS)
+
+STORE = get_store()
+
+# ================= 共享缓存 (多副本) =================
+# 直接在表格里改的内容要等条目过期 (SHARED_TTL 秒) 或点「刷新数据」才看得到
+@st.cache_resource(show_spinner=False)
+def get_shared_cache():
+    return open_shared_cache(SHARED_DB_PATH, PERF_APP, SHARED_TTL, SHARED_POLL)
+
+SHARED = get_shared_cache()
+
+# 读表: 三张表一起读 (表不存在时按表头建表)
+def read_tabs(tab_headers):
+    return read_through(STORE, SHARED, tab_headers)
+
+# 写过的表通知其他副本 (没配共享缓存时什么都不做)
+def publish_written(*tabs):
+    if not SHARED: return
+    try: SHARED.publish(list(tabs))
+    except: pass
+
+# 数值列在加载时一次性转换，后面的计算不再逐格 float()
+def typed_portfolio(df):
+    df = df.copy()
+    df["code"] = df["code"].astype(str).str.strip().str.zfill(6)
+    df["name"] = df["name"].astype(str)
+    df["proxy_code"] = df["proxy_code"].fillna("").astype(str).str.strip()
+    for c in ["shares", "avg_cost"]:
+        df[c] = pd.to_numeric(df[c], errors="coerce").fillna(0.0).astype(float)
+    # txn_seq: 这一行的份额/成本已经包含了流水表前多少条 (旧表没有这一列，按 0 处理)
+    if "txn_seq" not in df.columns: df["txn_seq"] = 0
+    df["txn_seq"] = pd.to_numeric(df["txn_seq"], errors="coerce").fillna(0).astype(int)
+    return df
+
+def typed_ledger(df):
+    df = df.copy()
+    df["code"] = df["code"].astype(str).str.strip().str.zfill(6)
+    for c in ["amount", "nav", "shares"]:
+        df[c] = pd.to_numeric(df[c], errors="coerce").fillna(0.0).astype(float)
+    df["seq"] = np.arange(1, len(df) + 1) # 流水序号 = 表里的第几条
+    return df
+
+def typed_sip(df):
+    df = df.copy()
+    df["fund_code"] = df["fund_code"].astype(str).str.strip().str.zfill(6)
+    df["daily_amount"] = pd.to_numeric(df["daily_amount"], errors="coerce").fillna(0.0).astype(float)
+    return df
+
+# 写回时的写法: 值没变的格子照抄读到的原字符串 (1000 不会变成 1000.0，代码不会被补零)，差异写入只提交真正改过的格子
+# 改过的数值整数写成整数，其余按 Python 的最短写法
+def stored_form(df, raw, typer):
+    old = typer(raw)
+    out = pd.DataFrame(index=df.index)
+    for c in df.columns:
+        if pd.api.types.is_numeric_dtype(df[c]): new = df[c].map(lambda v: str(int(v)) if float(v).is_integer() else str(float(v)))
+        else: new = df[c].astype(str)
+        if c in raw.columns:
+            same = old[c].reindex(df.index) == df[c]
+            new = new.where(~same, raw[c].reindex(df.index))
+        out[c] = new
+    return out
+
+def _frame(raw, default_cols):
+    if not raw: return pd.DataFrame(columns=default_cols)
+    return pd.DataFrame(raw[1:], columns=raw[0]) if len(raw) > 1 else pd.DataFrame(columns=raw[0])
+
+# 加载数据 (持仓表、定投表和流水表一次读回)
 def load_data():
-    sh = get_db_connection()
-    if not sh: return pd.DataFrame(), pd.DataFrame()
+    if not STORE: return pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
     try:
-        # 1. 读取持仓
-        try: ws_p = sh.worksheet(TAB_PORTFOLIO)
-        except: 
-            ws_p = sh.add_worksheet(title=TAB_PORTFOLIO, rows=100, cols=20)
-            ws_p.update([["code", "name", "shares", "avg_cost", "proxy_code"]])
-        
-        raw_p = ws_p.get_all_values()
-        if not raw_p: df_p = pd.DataFrame(columns=["code", "name", "shares", "avg_cost", "proxy_code"])
-        else:
-            headers = raw_p[0]
-            if "proxy_code" not in headers: headers.append("proxy_code") # 兼容旧表
-            df_p = pd.DataFrame(raw_p[1:], columns=headers) if len(raw_p)>1 else pd.DataFrame(columns=headers)
-        
-        # 2. 读取定投配置 (SIP)
-        try: ws_s = sh.worksheet(TAB_SIP)
-        except:
-            ws_s = sh.add_worksheet(title=TAB_SIP, rows=50, cols=10)
-            ws_s.update([["fund_code", "daily_amount", "last_run_date", "status"]]) # status: ON/OFF
-            
-        raw_s = ws_s.get_all_values()
-        if not raw_s: df_s = pd.DataFrame(columns=["fund_code", "daily_amount", "last_run_date", "status"])
-        else: df_s = pd.DataFrame(raw_s[1:], columns=raw_s[0])
-            
-        return df_p, df_s
-    except: return pd.DataFrame(), pd.DataFrame()
+        raw = read_tabs({TAB_PORTFOLIO: PORTFOLIO_COLS, TAB_SIP: SIP_COLS, TAB_TXN: TXN_COLS})
+        raw_p = [list(r) for r in raw[TAB_PORTFOLIO]]
+        if raw_p and "proxy_code" not in raw_p[0]: # 兼容旧表
+            raw_p = [r + [""] for r in raw_p]
+            raw_p[0][-1] = "proxy_code"
+        df_p = _frame(raw_p, PORTFOLIO_COLS)
+        df_s = _frame(raw[TAB_SIP], SIP_COLS)
+        df_t = _frame(raw[TAB_TXN], TXN_COLS)
+        st.session_state["stored"] = {TAB_PORTFOLIO: df_p, TAB_SIP: df_s} # 类型转换之前的原字符串，save_data 写回时用
+        return typed_portfolio(df_p), typed_sip(df_s), typed_ledger(df_t)
+    except: return pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
 
-# 保存数据 (通用)
+# 保存数据 (通用，只写和快照的差异)
 def save_data(tab_name, df):
-    sh = get_db_connection()
-    if not sh: return False
+    if not STORE: return False
+    raw = st.session_state.get("stored", {}).get(tab_name)
+    if raw is not None: df = stored_form(df, raw, {TAB_PORTFOLIO: typed_portfolio, TAB_SIP: typed_sip}[tab_name])
     try:
-        try: ws = sh.worksheet(tab_name)
-        except: ws = sh.add_worksheet(title=tab_name, rows=100, cols=20)
-        ws.clear()
-        if df.empty: ws.update([df.columns.values.tolist()])
-        else: ws.update([df.columns.values.tolist()] + df.astype(str).values.tolist())
+        STORE.save_tab(tab_name, df)
+        publish_written(tab_name)
         return True
     except: return False
 
+# ================= 行情接口保护 =================
+# 每个接口统计最近的耗时分位数: 超时取 p99 的 2 倍 (限制在上下限之间)，超过 p95 还没回来就再发一个对冲请求
+# 连续失败 BREAKER_FAILS 次熔断，冷却期内直接失败不联网，页面改用最近一次的数据并标记过期
+class CircuitOpen(Exception): pass
+
+class EndpointGuard:
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=200) # 最近成功请求的耗时
+        self.fails = 0
+        self.open_until = 0.0
+        self.probing = False
+
+    def _pct(self, q):
+        with self.lock: xs = sorted(self.samples)
+        if len(xs) < 20: return None
+        return xs[min(len(xs) - 1, int(q * len(xs)))]
+
+    def timeout(self):
+        p99 = self._pct(0.99)
+        if p99 is None: return QUOTE_TIMEOUT_MAX
+        return min(QUOTE_TIMEOUT_MAX, max(QUOTE_TIMEOUT_MIN, p99 * 2))
+
+    def hedge_after(self):
+        return self._pct(0.95)
+
+    def state(self):
+        with self.lock:
+            if self.fails < BREAKER_FAILS: return "closed"
+            return "open" if time.time() < self.open_until else "half-open"
+
+    # 熔断期内不放行；冷却结束后 (半开) 只放一个探测请求
+    def allow(self):
+        with self.lock:
+            if self.fails < BREAKER_FAILS: return True
+            if time.time() < self.open_until or self.probing: return False
+            self.probing = True
+            return True
+
+    def success(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+            self.fails = 0
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.fails += 1
+            self.probing = False
+            if self.fails >= BREAKER_FAILS: self.open_until = time.time() + BREAKER_COOLDOWN
+
+@st.cache_resource(show_spinner=False)
+def get_endpoint_guards():
+    return {"fundgz": EndpointGuard("fundgz"), "sina": EndpointGuard("sina")}
+
+# 对冲请求用的线程池，和批量抓取的线程池分开，避免互相等待
+@st.cache_resource(show_spinner=False)
+def get_hedge_pool():
+    return ThreadPoolExecutor(max_workers=QUOTE_WORKERS * 2, thread_name_prefix="quote-hedge")
+
+GUARDS = get_endpoint_guards()
+HEDGE_POOL = get_hedge_pool()
+
+# 带自适应超时、对冲和熔断的 GET；5xx 和异常都算失败
+# 对冲等待和超时从请求真正开始算，在线程池里排队的时间不算 (否则池子忙时好好的接口也会被判超时、熔断)
+def guarded_get(guard, session, url, ev=None, **kwargs):
+    if not guard.allow(): raise CircuitOpen(guard.name)
+    timeout = guard.timeout()
+    hedge = guard.hedge_after()
+    started = threading.Event()
+    def send():
+        started.set()
+        return (session or requests).get(url, timeout=timeout, **kwargs)
+    try:
+        jobs = [HEDGE_POOL.submit(send)]
+        started.wait()
+        t = time.perf_counter()
+        if hedge is not None and not wait(jobs, timeout=hedge).done:
+            jobs.append(HEDGE_POOL.submit(send))
+            if ev is not None: ev["retries"] += 1
+        err = None
+        for job in as_completed(jobs, timeout=max(0.0, timeout - (time.perf_counter() - t))):
+            try:
+                r = job.result()
+                break
+            except Exception as e: err = e
+        else: raise err
+    except Exception:
+        guard.failure()
+        raise
+    if r.status_code >= 500: guard.failure()
+    else: guard.success(time.perf_counter() - t)
+    return r
+
+# 行情连接池: 所有净值/影子请求复用同一组 TCP 连接
+@st.cache_resource
+def get_http_session():
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=QUOTE_WORKERS)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    return s
+
+# 追加买入流水: 一次 append_rows，不动持仓表
+def append_txns(rows):
+    if not rows: return True
+    if not STORE: return False
+    try: STORE.append_rows(TAB_TXN, [[str(v) for v in r] for r in rows])
+    except: return False
+    publish_written(TAB_TXN)
+    return True
+
+# 折叠缓存: 上一次折叠到第几条流水、结果是什么，下次只折叠新增的流水
+@st.cache_resource
+def get_fold_cache():
+    return {}
+
+def _fold(pos, txns):
+    txns = txns.merge(pos.drop_duplicates("code")[["code", "txn_seq"]], on="code")
+    txns = txns[txns["seq"] > txns["txn_seq"]] # 已经压缩进快照的跳过
+    agg = txns.groupby("code")[["amount", "shares"]].sum()
+    add_amt = pos["code"].map(agg["amount"]).fillna(0.0)
+    add_shares = pos["code"].map(agg["shares"]).fillna(0.0)
+    new_shares = pos["shares"] + add_shares
+    cost_val = pos["shares"] * pos["avg_cost"] + add_amt
+    pos["avg_cost"] = np.where(new_shares > 0, cost_val / new_shares.where(new_shares > 0, 1), pos["avg_cost"])
+    pos["shares"] = new_shares
+    return len(txns)
+
+# 持仓 = 持仓表快照 + 快照之后的流水；返回 (当前持仓, 尚未压缩进快照的流水条数)
+# 返回的持仓 txn_seq 已是最新，直接 save_data 写回持仓表就完成了压缩
+def fold_positions(df_fund, df_txn):
+    n = len(df_txn)
+    key = int(pd.util.hash_pandas_object(df_fund[PORTFOLIO_COLS]).sum()) if not df_fund.empty else 0
+    cache = get_fold_cache()
+    if cache.get("key") == key and cache["seq"] <= n:
+        pos, pending = cache["pos"].copy(), cache["pending"]
+        pending += _fold(pos, df_txn[df_txn["seq"] > cache["seq"]])
+    else:
+        pos = df_fund.copy()
+        pending = _fold(pos, df_txn) if n else 0
+    pos["txn_seq"] = n
+    cache.update(key=key, seq=n, pos=pos.copy(), pending=pending)
+    return pos, pending
+
 # 接口: 获取官方净值 (用于计算定投份额)
-def get_official_nav(fund_code):
+def get_official_nav(fund_code, session=None):
     url = f"http://fundgz.1234567.com.cn/js/{fund_code}.js"
     try:
-        r = requests.get(url, timeout=2)
-        if r.status_code == 200:
-            match = re.search(r'jsonpgz\((.*?)\);', r.text)
-            if match:
-                data = json.loads(match.group(1))
-                return {"nav": float(data['dwjz']), "date": data['jzrq'], "name": data['name']}
+        with perf("http", "fundgz", fund_code) as ev:
+            try: r = guarded_get(GUARDS["fundgz"], session, url, ev)
+            except CircuitOpen:
+                ev["outcome"] = "breaker_open"
+                return None
+            ev["bytes"] = len(r.content)
+            ev["outcome"] = "ok" if r.status_code == 200 else f"http_{r.status_code}"
+            if r.status_code == 200:
+                match = re.search(r'jsonpgz\((.*?)\);', r.text)
+                if match:
+                    data = json.loads(match.group(1))
+                    return {"nav": float(data['dwjz']), "date": data['jzrq'], "name": data['name']}
+                ev["outcome"] = "empty"
     except: pass
     return None
 
-# 接口: 影子实时涨跌
-def get_proxy_rate(proxy_code):
-    if not proxy_code or len(proxy_code) < 6: return 0.0
-    url = f"http://hq.sinajs.cn/list={proxy_code}"
-    try:
-        headers = {"Referer": "https://finance.sina.com.cn"}
-        r = requests.get(url, headers=headers, timeout=2)
-        if r.status_code == 200:
-            data = r.text.split(",")
-            if len(data) > 3:
-                yesterday = float(data[2])
-                current = float(data[3])
-                if current == 0: current = yesterday
-                if yesterday == 0: return 0.0
-                return ((current - yesterday) / yesterday) * 100
-    except: pass
+# 净值缓存: 内存 LRU + 可选落盘，按基金代码存最新一条 (含 jzrq)
+# 净值日期已是最近交易日 -> 直到下个交易日都不再联网；否则按 NAV_TTL 短周期刷新
+# 查询失败也缓存 NAV_FAIL_TTL 秒，避免失效代码每次刷新都卡 2 秒
+class NavCache:
+    def __init__(self, maxsize=NAV_CACHE_SIZE, disk_dir=NAV_CACHE_DIR):
+        self.maxsize = maxsize
+        self.disk_dir = disk_dir
+        self.lock = threading.Lock()
+        self.items = OrderedDict() # code -> (info, fetched_at)
+        self.last_good = {} # code -> info
+        if disk_dir: os.makedirs(disk_dir, exist_ok=True)
+
+    def _path(self, code):
+        return os.path.join(self.disk_dir, f"{code}.json")
+
+    def _load_disk(self, code):
+        if not self.disk_dir: return None
+        try:
+            with open(self._path(code), encoding="utf-8") as f:
+                d = json.load(f)
+            return d["info"], d["fetched_at"]
+        except: return None
+
+    def _remember(self, code, entry):
+        self.items[code] = entry
+        self.items.move_to_end(code)
+        while len(self.items) > self.maxsize: self.items.popitem(last=False)
+
+    # 返回 (是否命中, 净值信息)；命中失败缓存时信息为 None
+    def get(self, code, today):
+        with self.lock:
+            entry = self.items.get(code)
+            if entry: self.items.move_to_end(code)
+        if entry is None:
+            entry = self._load_disk(code)
+            if entry is None: return False, None
+            with self.lock: self._remember(code, entry)
+        info, fetched_at = entry
+        age = time.time() - fetched_at
+        if info is None: return age < NAV_FAIL_TTL, None
+        if info["date"] >= last_trading_day(today): return True, info
+        return age < NAV_TTL, info
+
+    # 最近一次成功拿到的净值 (不管是否过期)，接口熔断时兜底用
+    def last_known(self, code):
+        with self.lock: info = self.last_good.get(code)
+        if info is None:
+            entry = self._load_disk(code)
+            if entry: info = entry[0]
+        return info
+
+    def put(self, code, info):
+        entry = (info, time.time())
+        with self.lock:
+            self._remember(code, entry)
+            if info: self.last_good[code] = info
+        if info and self.disk_dir:
+            try:
+                with open(self._path(code), "w", encoding="utf-8") as f:
+                    json.dump({"info": info, "fetched_at": entry[1]}, f, ensure_ascii=False)
+            except: pass
+
+@st.cache_resource
+def get_nav_cache():
+    return NavCache()
+
+# 带缓存的官方净值，页面和定投补单都走这里
+def get_nav(fund_code, session=None, cache=None):
+    cache = cache or get_nav_cache()
+    hit, info = cache.get(fund_code, get_today_str())
+    if hit: return info
+    info = get_official_nav(fund_code, session)
+    cache.put(fund_code, info)
+    return info
+
+# 历史净值库: 进程内共享一个 SQLite 连接
+@st.cache_resource
+def get_nav_history():
+    return NavHistory(NAV_DB_PATH)
+
+# 并发增量同步多只基金的历史净值，starts = {基金代码: 最早需要的日期}
+def sync_nav_history(starts):
+    hist = get_nav_history()
+    session = get_http_session()
+    today = get_today_str()
+    with ThreadPoolExecutor(max_workers=QUOTE_WORKERS) as pool:
+        list(pool.map(lambda c: _timed_sync(hist, c, starts[c], today, session), starts))
+    return hist
+
+def _timed_sync(hist, code, start, end, session):
+    with perf("http", "lsjz", code) as ev:
+        if not hist.sync(code, start, end, session): ev["outcome"] = "error"
+
+# 接口: 影子实时涨跌 (批量)
+# 新浪接口支持 list=a,b,c，每个代码返回一行 var hq_str_xxx="..."
+def _sina_rate(fields):
+    data = fields.split(",")
+    if len(data) > 3:
+        try:
+            yesterday = float(data[2])
+            current = float(data[3])
+        except ValueError: return 0.0
+        if current == 0: current = yesterday
+        if yesterday == 0: return 0.0
+        return ((current - yesterday) / yesterday) * 100
     return 0.0
 
+def _sina_chunks(codes):
+    base = len("http://hq.sinajs.cn/list=")
+    chunk, size = [], base
+    for c in codes:
+        if chunk and size + len(c) + 1 > SINA_URL_MAX:
+            yield chunk
+            chunk, size = [], base
+        chunk.append(c)
+        size += len(c) + 1
+    if chunk: yield chunk
+
+# 只返回拿到了行情的代码 (无效代码记 0)，请求失败的代码不出现在结果里
+def get_proxy_rates(proxy_codes, session=None):
+    codes = list(dict.fromkeys(str(c).strip() for c in proxy_codes))
+    rates = {c: 0.0 for c in codes if len(c) < 6}
+    valid = [c for c in codes if len(c) >= 6]
+    headers = {"Referer": "https://finance.sina.com.cn"}
+    for chunk in _sina_chunks(valid):
+        url = f"http://hq.sinajs.cn/list={','.join(chunk)}"
+        try:
+            with perf("http", "sina", f"{len(chunk)} codes") as ev:
+                try: r = guarded_get(GUARDS["sina"], session, url, ev, headers=headers)
+                except CircuitOpen:
+                    ev["outcome"] = "breaker_open"
+                    continue
+                ev["bytes"] = len(r.content)
+                ev["outcome"] = "ok" if r.status_code == 200 else f"http_{r.status_code}"
+                if r.status_code == 200:
+                    wanted = set(chunk)
+                    for sym, fields in re.findall(r'var hq_str_(\w+)="(.*?)";', r.text):
+                        if sym in wanted: rates[sym] = _sina_rate(fields)
+        except: pass
+    return rates
+
+def get_proxy_rate(proxy_code, session=None):
+    if not proxy_code or len(proxy_code) < 6: return 0.0
+    return get_proxy_rates([proxy_code], session).get(proxy_code, 0.0)
+
+# 批量行情: 整个组合的净值和影子请求同时发出，总耗时只取决于最慢的一个
+def fetch_quotes(codes, proxy_codes, session=None, cache=None):
+    session = session or get_http_session()
+    cache = cache or get_nav_cache()
+    codes = list(dict.fromkeys(codes))
+    with ThreadPoolExecutor(max_workers=QUOTE_WORKERS) as pool:
+        nav_jobs = {c: pool.submit(get_nav, c, session, cache) for c in codes}
+        # 影子代码去重后合并成一次批量请求，与净值请求并行
+        rate_job = pool.submit(get_proxy_rates, [p for p in proxy_codes if p], session)
+        navs = {c: job.result() for c, job in nav_jobs.items()}
+        rates = rate_job.result()
+    return navs, rates
+
+# 行情快照: 发布后不再修改，页面随时拿最新的一份直接渲染
+class QuoteSnapshot(NamedTuple):
+    navs: MappingProxyType
+    rates: MappingProxyType
+    updated_at: float # time.time()，0 表示还没有数据
+    stale: frozenset = frozenset() # 这次没刷新成功、沿用旧值的代码
+
+# 后台行情刷新: 每个进程一个线程，轮询所有打开页面用到的基金代码的并集
+# 盘中按 QUOTE_REFRESH_SECONDS 刷新，其余时间按 QUOTE_IDLE_SECONDS，打开多少个页面都只轮询一份
+class QuoteRefresher:
+    def __init__(self, session, cache):
+        self.session = session
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.busy = threading.Lock() # 同一时间只跑一轮刷新 (后台轮询、手动刷新、watch 新代码)，请求数不会叠到把线程池排满
+        self.codes = set()
+        self.proxies = set()
+        self.snapshot = QuoteSnapshot(MappingProxyType({}), MappingProxyType({}), 0.0)
+        threading.Thread(target=self._loop, name="quote-refresher", daemon=True).start()
+
+    def latest(self):
+        return self.snapshot
+
+    # 登记页面关心的代码；有新代码时立即同步刷新一次，保证首屏有数据
+    def watch(self, codes, proxies):
+        codes, proxies = set(codes), set(p for p in proxies if p)
+        with self.lock:
+            fresh = not (codes <= self.codes and proxies <= self.proxies)
+            self.codes |= codes
+            self.proxies |= proxies
+        if fresh: self.refresh()
+
+    def refresh(self):
+        with self.busy:
+            with self.lock: codes, proxies = list(self.codes), list(self.proxies)
+            if not codes and not proxies: return
+            navs, rates = fetch_quotes(codes, proxies, self.session, self.cache)
+            # 没拿到的沿用上一份快照 (净值再退一步用缓存里最近一次成功的)，并记为过期
+            prev, stale = self.snapshot, set()
+            for c in codes:
+                if navs.get(c) is None:
+                    navs[c] = prev.navs.get(c) or self.cache.last_known(c)
+                    stale.add(c)
+            for p in proxies:
+                if p not in rates:
+                    if p in prev.rates: rates[p] = prev.rates[p]
+                    stale.add(p)
+            self.snapshot = QuoteSnapshot(MappingProxyType(navs), MappingProxyType(rates), time.time(), frozenset(stale))
+
+    def _loop(self):
+        while True:
+            bj_date, bj_time = get_beijing_time()
+            wait = QUOTE_REFRESH_SECONDS if is_trading_session(bj_date, bj_time) else QUOTE_IDLE_SECONDS
+            if time.time() - self.snapshot.updated_at >= wait:
+                try: self.refresh()
+                except: pass
+            time.sleep(QUOTE_REFRESH_SECONDS)
+
+@st.cache_resource
+def get_quote_refresher():
+    return QuoteRefresher(get_http_session(), get_nav_cache())
+
+# 行情字典 -> 与持仓表逐行对齐的数组 (缺失净值为 NaN，缺失涨幅为 0)
+def quote_arrays(df, nav_map, rate_map, stale_codes=frozenset()):
+    ok = {c: i for c, i in nav_map.items() if i}
+    nav = df["code"].map({c: i["nav"] for c, i in ok.items()}).to_numpy(dtype=float)
+    nav_date = df["code"].map({c: i["date"] for c, i in ok.items()}).fillna("").to_numpy(dtype=object)
+    rate = df["proxy_code"].map(rate_map).fillna(0.0).to_numpy(dtype=float)
+    stale = (df["code"].isin(stale_codes) | df["proxy_code"].isin(stale_codes)).to_numpy()
+    return nav, nav_date, rate, stale
+
+# 估值引擎: 整列计算每只基金的市值/成本/盈亏以及汇总
+# 官方净值日期 == 今天 -> 盘后模式，直接用净值；否则盘中模式，用影子涨幅估算
+# stale 为 True 的行在“数据源”里标记过期 (接口熔断/失败时沿用的旧值)
+def value_portfolio(df, nav, nav_date, rate, today, stale=None):
+    shares = df["shares"].to_numpy(dtype=float)
+    avg_cost = df["avg_cost"].to_numpy(dtype=float)
+    proxy = df["proxy_code"]
+
+    nav_base = np.where(np.isnan(nav), avg_cost, nav)
+    is_updated = nav_date == today
+    day_rate = np.where(is_updated, 0.0, rate) # 盘后暂不显示涨幅，只看盈亏
+    real_price = nav_base * (1 + day_rate / 100)
+    day_profit = np.where(is_updated, 0.0, (real_price - nav_base) * shares)
+
+    m_val = real_price * shares
+    c_val = avg_cost * shares
+    t_profit = m_val - c_val
+    ret = np.divide(t_profit * 100, c_val, out=np.zeros_like(t_profit), where=c_val > 0)
+
+    shadow = np.where(proxy != "", "⚡ 影子(" + proxy + ")", "⚠️ 无影子")
+    source = np.where(is_updated, "✅ 官方净值", shadow)
+    if stale is not None: source = np.where(stale, "⏳ 过期 · " + source.astype(object), source)
+    table = pd.DataFrame({
+        "基金名称": (df["name"] + "\n(" + df["code"] + ")").to_numpy(),
+        "成本价": avg_cost, # 用户要的对比列
+        "今日估值": real_price, # 用户要的对比列
+        "涨幅": day_rate,
+        "今日盈亏": day_profit,
+        "总盈亏": t_profit,
+        "收益率": ret,
+        "数据源": source,
+    })
+    totals = {"market": m_val.sum(), "cost": c_val.sum(), "day_profit": day_profit.sum()}
+    return table, totals
+
+# 看板片段: 按刷新间隔自动重跑，只更新指标卡和持仓表，不重读表格
+@st.fragment(run_every=QUOTE_REFRESH_SECONDS)
+def render_dashboard(df_fund):
+    start_fragment_perf()
+    bj_date = get_today_str()
+    snap = get_quote_refresher().latest()
+
+    # --- 2. 主表格计算逻辑 ---
+    table_df = pd.DataFrame()
+    totals = {"market": 0.0, "cost": 0.0, "day_profit": 0.0}
+
+    if not df_fund.empty:
+        with perf("cpu", "valuation", f"{len(df_fund)} funds"):
+            nav, nav_date, rate, stale = quote_arrays(df_fund, snap.navs, snap.rates, snap.stale)
+            table_df, totals = value_portfolio(df_fund, nav, nav_date, rate, bj_date, stale)
+
+    total_market = totals["market"]
+    total_cost = totals["cost"]
+    total_day_profit = totals["day_profit"]
+
+    # --- 3. 资产驾驶舱 ---
+    ret_rate = (total_market - total_cost)/total_cost*100 if total_cost>0 else 0
+    k1, k2, k3, k4 = st.columns(4)
+    k1.metric("总持仓", f"¥{total_market:,.0f}")
+    k2.metric("今日预估", f"¥{total_day_profit:,.0f}", delta=f"{total_day_profit:,.0f}", delta_color="inverse")
+    k3.metric("总盈亏", f"¥{(total_market-total_cost):,.0f}", delta_color="inverse")
+    k4.metric("总收益率", f"{ret_rate:+.2f}%")
+
+    st.divider()
+
+    # --- 4. 持仓明细表 (按用户需求调整列顺序) ---
+    if not table_df.empty:
+        st.dataframe(
+            table_df,
+            use_container_width=True,
+            column_config={
+                "成本价": st.column_config.NumberColumn(format="%.4f", help="你的持仓成本"),
+                "今日估值": st.column_config.NumberColumn(format="%.4f", help="基于影子涨幅的预估单价"),
+                "今日盈亏": st.column_config.NumberColumn(format="¥%.2f"),
+                "总盈亏": st.column_config.NumberColumn(format="¥%.2f"),
+                "涨幅": st.column_config.NumberColumn(format="%+.2f%%"),
+                "收益率": st.column_config.NumberColumn(format="%.2f%%"),
+            },
+            hide_index=True
+        )
+
+    broken = [name for name, g in GUARDS.items() if g.state() != "closed"]
+    if broken: st.caption(f"⚠️ {', '.join(broken)} 接口熔断中，标记“过期”的行显示的是最近一次的数据")
+    if snap.updated_at:
+        st.caption(f"行情更新于 {datetime.utcfromtimestamp(snap.updated_at + 8 * 3600):%H:%M:%S}")
+    st.divider()
+
 # ================= 3. 页面主程序 =================
 st.set_page_config(page_title="智能资产看板", page_icon="📈", layout="wide")
 
@@ -123,89 +668,89 @@ if not st.session_state.auth:
         else: st.error("密码错误")
 else:
     bj_date, bj_time = get_beijing_time()
-    df_fund, df_sip = load_data()
+    df_fund, df_sip, df_txn = load_data()
+    if not df_fund.empty:
+        with perf("cpu", "fold", f"{len(df_txn)} txns"):
+            df_fund, pending_txns = fold_positions(df_fund, df_txn)
+        if pending_txns >= LEDGER_COMPACT_EVERY: save_data(TAB_PORTFOLIO, df_fund) # 定期压缩
     
     # --- 1. 智能定投检查 (Auto-SIP Check) ---
-    # 逻辑：检查上次执行日期和今天之间，有多少个工作日
+    # 逻辑：检查上次执行日期和今天之间，有多少个交易日
     sip_pending_msg = []
     sip_execution_plan = [] # 存储待执行计划
     
     if not df_sip.empty and not df_fund.empty:
-        today_dt = datetime.strptime(bj_date, "%Y-%m-%d").date()
-        
-        for idx, row in df_sip.iterrows():
-            if row["status"] != "ON": continue
-            
-            f_code = str(row["fund_code"])
-            amt = float(row["daily_amount"])
-            last_run = row["last_run_date"]
-            
-            if not last_run: # 第一次设置，今天不算，下次算
+        # 只看开启中、且有上次执行日期的计划 (第一次设置，今天不算，下次算)
+        last_run = pd.to_datetime(df_sip["last_run_date"], format="%Y-%m-%d", errors="coerce")
+        active = df_sip[(df_sip["status"] == "ON") & last_run.notna()]
+        # 一次算出所有计划错过的交易日数 (排除周末和节假日)
+        missed = count_trading_days(last_run[active.index].to_numpy(dtype="datetime64[D]"), bj_date)
+        fund_names = df_fund.drop_duplicates("code").set_index("code")["name"]
+        # 流水里已经有的定投补单 (上次记了流水、定投日期却没保存上)，这些天不再重复扣
+        sip_txns = df_txn[df_txn["source"] == "定投补单"]
+        booked = set(zip(sip_txns["code"], sip_txns["date"]))
+        caught_up = False
+
+        for idx, missed_days in zip(active.index, missed):
+            if missed_days <= 0: continue
+            f_code = df_sip.at[idx, "fund_code"]
+            f_name = fund_names.get(f_code, "未知基金")
+            days = [d for d in trading_days_between(df_sip.at[idx, "last_run_date"], bj_date) if (f_code, d) not in booked]
+            if not days: # 错过的天都记过流水了，只差推进日期
+                df_sip.at[idx, "last_run_date"] = bj_date
+                caught_up = True
                 continue
-                
-            last_run_dt = datetime.strptime(last_run, "%Y-%m-%d").date()
-            
-            # 计算相差天数
-            delta = (today_dt - last_run_dt).days
-            if delta > 0:
-                # 遍历中间的每一天
-                missed_days = 0
-                for i in range(1, delta + 1):
-                    check_day = last_run_dt + timedelta(days=i)
-                    # 关键逻辑：排除周六(5)和周日(6)
-                    if check_day.weekday() < 5: 
-                        missed_days += 1
-                
-                if missed_days > 0:
-                    # 找到对应的基金名称
-                    f_name = "未知基金"
-                    found_f = df_fund[df_fund["code"] == f_code]
-                    if not found_f.empty: f_name = found_f.iloc[0]["name"]
-                    
-                    total_amt = missed_days * amt
-                    sip_pending_msg.append(f"• **{f_name} ({f_code})**: 补扣 {missed_days} 天 (共 ¥{total_amt:,.0f})")
-                    
-                    sip_execution_plan.append({
-                        "code": f_code,
-                        "add_amt": total_amt,
-                        "days_count": missed_days,
-                        "sip_idx": idx # 记录定投表里的行号，方便更新日期
-                    })
+            missed_days = len(days)
+
+            total_amt = missed_days * df_sip.at[idx, "daily_amount"]
+            sip_pending_msg.append(f"• **{f_name} ({f_code})**: 补扣 {missed_days} 天 ({days[0]} ~ {days[-1]}，共 ¥{total_amt:,.0f})")
+
+            sip_execution_plan.append({
+                "code": f_code,
+                "add_amt": total_amt,
+                "days_count": missed_days,
+                "days": days, # 错过的每一个交易日
+                "sip_idx": idx # 记录定投表里的行号，方便更新日期
+            })
+        if caught_up: save_data(TAB_SIP, df_sip)
 
     # 如果有待执行的定投，显示在最显眼的地方
     if sip_pending_msg:
         with st.container(border=True):
             st.markdown("### 🔔 定投补单提醒")
-            st.info("检测到您有未执行的定投计划（已自动跳过周末）：")
+            st.info("检测到您有未执行的定投计划（已自动跳过周末和节假日）：")
             for msg in sip_pending_msg: st.write(msg)
             
             c_exec1, c_exec2 = st.columns([1, 4])
             if c_exec1.button("🚀 一键执行补单", type="primary"):
                 # 执行补单逻辑
                 logs = []
+                txn_rows = []
+                hist = sync_nav_history({p["code"]: p["days"][0] for p in sip_execution_plan})
                 for plan in sip_execution_plan:
                     code = plan["code"]
                     add_money = plan["add_amt"]
+                    daily_money = add_money / plan["days_count"]
                     
-                    # 获取当前最新净值作为成交价 (这是补单的折中方案)
-                    info = get_official_nav(code)
-                    if info:
-                        nav = info['nav']
-                        
-                        # 更新持仓表
+                    # 每个错过的交易日按当天净值成交；当天净值还没公布的，用最新净值兜底
+                    navs = hist.navs_on(code, plan["days"])
+                    if np.isnan(navs).any():
+                        info = get_nav(code)
+                        if info: navs = np.where(np.isnan(navs), info['nav'], navs)
+                    if not np.isnan(navs).any():
                         f_idx_list = df_fund[df_fund["code"] == code].index
                         if len(f_idx_list) > 0:
                             f_idx = f_idx_list[0]
-                            old_shares = float(df_fund.at[f_idx, "shares"] or 0)
-                            old_cost = float(df_fund.at[f_idx, "avg_cost"] or 0)
+                            old_shares = df_fund.at[f_idx, "shares"]
+                            old_cost = df_fund.at[f_idx, "avg_cost"]
                             
-                            new_shares_add = add_money / nav
-                            total_shares = old_shares + new_shares_add
-                            total_cost_val = (old_shares * old_cost) + add_money
-                            new_avg_cost = total_cost_val / total_shares
+                            # 每个交易日记一条流水
+                            day_shares = daily_money / navs
+                            for d, d_nav, d_shares in zip(plan["days"], navs, day_shares):
+                                txn_rows.append([d, code, daily_money, d_nav, d_shares, "定投补单"])
                             
-                            df_fund.at[f_idx, "shares"] = total_shares
-                            df_fund.at[f_idx, "avg_cost"] = new_avg_cost
+                            total_shares = old_shares + day_shares.sum()
+                            new_avg_cost = ((old_shares * old_cost) + add_money) / total_shares
                             
                             # 更新定投表的日期为今天
                             df_sip.at[plan["sip_idx"], "last_run_date"] = bj_date
@@ -214,9 +759,13 @@ else:
                         else:
                             logs.append(f"错误：持仓表中找不到 {code}，请先建仓")
                 
-                # 保存
-                save_data(TAB_PORTFOLIO, df_fund)
-                save_data(TAB_SIP, df_sip)
+                # 保存: 先记流水，成功了再推进定投日期；日期没保存上的，已经记过流水的天下次打开会跳过，不会重复扣
+                if not append_txns(txn_rows):
+                    st.error("流水写入失败，请重试")
+                    st.stop()
+                if not save_data(TAB_SIP, df_sip):
+                    st.warning("流水已记下，但定投日期保存失败 (已记过的天下次不会重复补扣)")
+                    st.stop()
                 st.success("✅ 所有定投已执行！")
                 st.session_state.logs = logs
                 time.sleep(2)
@@ -226,89 +775,15 @@ else:
     c_t, c_r = st.columns([3, 1])
     with c_t: st.subheader(f"📈 智能资产看板")
     with c_r: 
-        if st.button("🔄 刷新数据"): st.rerun()
-
-    # --- 2. 主表格计算逻辑 ---
-    total_market = 0.0
-    total_cost = 0.0
-    total_day_profit = 0.0
-    table_data = []
+        if st.button("🔄 刷新数据"):
+            publish_written("*") # 共享缓存里的表也重读
+            get_quote_refresher().refresh()
+            st.rerun()
 
+    # --- 2~4. 行情看板: 后台线程刷新行情，这里只读最新快照 ---
     if not df_fund.empty:
-        for i, row in df_fund.iterrows():
-            code = str(row["code"]).zfill(6)
-            proxy = str(row["proxy_code"]).strip()
-            shares = float(row["shares"] or 0)
-            avg_cost = float(row["avg_cost"] or 0)
-            
-            # 官方净值
-            off_info = get_official_nav(code)
-            nav_base = avg_cost
-            if off_info: nav_base = off_info['nav']
-            
-            # 判断逻辑：官方净值日期是否是今天
-            is_updated = (off_info and off_info['date'] == bj_date)
-            
-            if is_updated:
-                # 盘后模式
-                real_price = nav_base
-                source = "✅ 官方净值"
-                day_rate = 0.0 # 盘后暂不显示涨幅，只看盈亏
-                day_profit = 0.0 # 难算，略过
-            else:
-                # 盘中模式
-                proxy_rate = get_proxy_rate(proxy)
-                day_rate = proxy_rate
-                real_price = nav_base * (1 + day_rate/100)
-                source = f"⚡ 影子({proxy})" if proxy else "⚠️ 无影子"
-                day_profit = (real_price - nav_base) * shares
-
-            # 汇总
-            m_val = real_price * shares
-            c_val = avg_cost * shares
-            t_profit = m_val - c_val
-            
-            total_market += m_val
-            total_cost += c_val
-            total_day_profit += day_profit
-            
-            table_data.append({
-                "基金名称": f"{row['name']}\n({code})",
-                "成本价": avg_cost, # 用户要的对比列
-                "今日估值": real_price, # 用户要的对比列
-                "涨幅": f"{day_rate:+.2f}%",
-                "今日盈亏": day_profit,
-                "总盈亏": t_profit,
-                "收益率": f"{(t_profit/c_val)*100:.2f}%" if c_val>0 else "0%",
-                "数据源": source
-            })
-
-    # --- 3. 资产驾驶舱 ---
-    ret_rate = (total_market - total_cost)/total_cost*100 if total_cost>0 else 0
-    k1, k2, k3, k4 = st.columns(4)
-    k1.metric("总持仓", f"¥{total_market:,.0f}")
-    k2.metric("今日预估", f"¥{total_day_profit:,.0f}", delta=f"{total_day_profit:,.0f}", delta_color="inverse")
-    k3.metric("总盈亏", f"¥{(total_market-total_cost):,.0f}", delta_color="inverse")
-    k4.metric("总收益率", f"{ret_rate:+.2f}%")
-
-    st.divider()
-
-    # --- 4. 持仓明细表 (按用户需求调整列顺序) ---
-    if table_data:
-        st.dataframe(
-            pd.DataFrame(table_data),
-            use_container_width=True,
-            column_config={
-                "成本价": st.column_config.NumberColumn(format="%.4f", help="你的持仓成本"),
-                "今日估值": st.column_config.NumberColumn(format="%.4f", help="基于影子涨幅的预估单价"),
-                "今日盈亏": st.column_config.NumberColumn(format="¥%.2f"),
-                "总盈亏": st.column_config.NumberColumn(format="¥%.2f"),
-                "收益率": st.column_config.TextColumn(),
-            },
-            hide_index=True
-        )
-
-    st.divider()
+        get_quote_refresher().watch(df_fund["code"], df_fund["proxy_code"])
+    render_dashboard(df_fund)
 
     # --- 5. 操作与设置区 ---
     tab_buy, tab_sip, tab_new = st.tabs(["💰 单笔加仓", "📅 定投计划设置", "⚙️ 建仓/管理"])
@@ -323,22 +798,21 @@ else:
                 code = sel_fund.split(" - ")[0]
                 idx = df_fund[df_fund["code"]==code].index[0]
                 
-                old_s = float(df_fund.at[idx, "shares"])
-                old_c = float(df_fund.at[idx, "avg_cost"])
+                old_s = df_fund.at[idx, "shares"]
+                old_c = df_fund.at[idx, "avg_cost"]
                 
                 add_s = buy_amt / deal_nav
                 new_s = old_s + add_s
                 new_c = ((old_s * old_c) + buy_amt) / new_s
                 
-                df_fund.at[idx, "shares"] = new_s
-                df_fund.at[idx, "avg_cost"] = new_c
-                save_data(TAB_PORTFOLIO, df_fund)
-                st.success(f"加仓成功！新成本: {new_c:.4f}")
+                if append_txns([[bj_date, code, buy_amt, deal_nav, add_s, "单笔加仓"]]):
+                    st.success(f"加仓成功！新成本: {new_c:.4f}")
+                else: st.error("流水写入失败，请重试")
                 time.sleep(1)
                 st.rerun()
 
     with tab_sip:
-        st.caption("设置这里的计划后，每次打开网页，系统会自动检查是否需要补扣（自动跳过周末）。")
+        st.caption("设置这里的计划后，每次打开网页，系统会自动检查是否需要补扣（自动跳过周末和节假日）。")
         if not df_fund.empty:
             c_s1, c_s2, c_s3 = st.columns([2, 1, 1])
             s_fund = c_s1.selectbox("选择定投基金", df_fund["code"] + " - " + df_fund["name"], key="sip_sel")
@@ -389,6 +863,12 @@ else:
                         df_fund.at[idx, "avg_cost"] = n_cost
                         if n_n: df_fund.at[idx, "name"] = n_n
                     else:
-                        df_fund = pd.concat([df_fund, pd.DataFrame([{"code":n_c, "name":n_n, "shares":n_s, "avg_cost":n_cost, "proxy_code":n_p}])], ignore_index=True)
+                        df_fund = pd.concat([df_fund, pd.DataFrame([{"code":n_c, "name":n_n, "shares":n_s, "avg_cost":n_cost, "proxy_code":n_p, "txn_seq":len(df_txn)}])], ignore_index=True)
                     save_data(TAB_PORTFOLIO, df_fund)
                     st.rerun()
+
+    # --- 6. 性能面板 (可选) ---
+    st.divider()
+    if st.toggle("⏱ 性能"): render_perf_panel()
+
+PERF.flush()
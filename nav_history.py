@@ -0,0 +1,66 @@
+# 本地历史净值库 (SQLite): 每只基金每个净值日一行
+# 同步是增量的，只向天天基金请求库里已有区间前后缺的数据
+import sqlite3
+import threading
+import numpy as np
+import requests
+from datetime import datetime, timedelta
+
+LSJZ_URL = "http://api.fund.eastmoney.com/f10/lsjz"
+LSJZ_HEADERS = {"Referer": "http://fundf10.eastmoney.com/"}
+PAGE_SIZE = 20 # 接口单页上限
+
+# 接口: 历史净值 [start, end]，返回 [(日期, 单位净值), ...]
+def fetch_history(code, start, end, session=None):
+    rows, page = [], 1
+    while True:
+        params = {"fundCode": code, "pageIndex": page, "pageSize": PAGE_SIZE, "startDate": start, "endDate": end}
+        r = (session or requests).get(LSJZ_URL, params=params, headers=LSJZ_HEADERS, timeout=5)
+        data = r.json()
+        items = (data.get("Data") or {}).get("LSJZList") or []
+        rows += [(it["FSRQ"], float(it["DWJZ"])) for it in items if it.get("DWJZ")]
+        if not items or page * PAGE_SIZE >= int(data.get("TotalCount") or 0): break
+        page += 1
+    return rows
+
+class NavHistory:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS nav (code TEXT, date TEXT, nav REAL, PRIMARY KEY (code, date))")
+
+    # 库里这只基金最早和最后一天 (没有时都是 None)
+    def date_range(self, code):
+        with self.lock:
+            return self.conn.execute("SELECT MIN(date), MAX(date) FROM nav WHERE code = ?", (code,)).fetchone()
+
+    # 增量同步 [start, end]: 库里没有这只基金时整段拉；有的话只拉最早一天之前 (start 更早时) 和最后一天之后的
+    def sync(self, code, start, end, session=None):
+        first, last = self.date_range(code)
+        shift = lambda d, n: (datetime.strptime(d, "%Y-%m-%d") + timedelta(days=n)).strftime("%Y-%m-%d")
+        spans = [(start, end)] if not first else [(start, shift(first, -1)), (shift(last, 1), end)]
+        for a, b in spans:
+            if a > b: continue
+            try: rows = fetch_history(code, a, b, session)
+            except: return False
+            with self.lock, self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO nav VALUES (?, ?, ?)", [(code, d, v) for d, v in rows])
+        return True
+
+    # 指定日期的净值数组，库里没有的日期为 NaN
+    def navs_on(self, code, days):
+        days = list(days)
+        if not days: return np.array([])
+        with self.lock:
+            got = dict(self.conn.execute(
+                "SELECT date, nav FROM nav WHERE code = ? AND date BETWEEN ? AND ?", (code, min(days), max(days))
+            ).fetchall())
+        return np.array([got.get(d, np.nan) for d in days], dtype=float)
+
+    # 一段时间的净值序列，给历史走势之类的视图用
+    def series(self, code, start="0000-00-00", end="9999-99-99"):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT date, nav FROM nav WHERE code = ? AND date BETWEEN ? AND ? ORDER BY date", (code, start, end)
+            ).fetchall()
@@ -0,0 +1,1083 @@
+# fund.py 和 team_tool/app.py 共用的数据层: 性能埋点、差异写入、谷歌表格/SQLite 存储后端、多副本共享缓存，
+# 以及团队工具用的后台写队列和协作表三方合并
+# 表的内容一律是含表头的二维字符串数组；应用里用 st.cache_resource 建一次后端和共享缓存，这里不关心具体有哪些表
+import difflib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+import gspread
+import numpy as np
+import pandas as pd
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+# ================= 1. 性能埋点 =================
+# 每次外部调用 (谷歌表格/行情接口) 和主要计算都记一条: 类别、操作、目标、耗时、字节数、结果、重试次数
+# 本次 rerun 的明细放在会话里 (性能面板画瀑布图)，进程累计的计数和直方图导出到 PERF_DIR
+PERF_DIR = ".perf" # perf_<应用名>.jsonl 逐条明细，perf_<应用名>.prom 为 Prometheus 文本格式，设为 None 不导出
+PERF_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5] # 直方图分桶 (秒)
+PERF_RUN_EVENTS = 500 # 会话里最多留本次 rerun 的多少条明细
+PERF_JSONL_BYTES = 20_000_000 # 明细文件超过这么大就改名成 .jsonl.1 (只留一份旧的)，重新开一个
+
+class PerfRecorder:
+    def __init__(self, app, out_dir=PERF_DIR):
+        self.app = app
+        self.out_dir = out_dir
+        self.lock = threading.Lock()
+        self.calls = Counter() # (kind, op, outcome) -> 次数
+        self.bytes = Counter() # (kind, op) -> 字节数
+        self.retries = Counter() # (kind, op) -> 重试次数
+        self.hist = {} # (kind, op) -> [各桶累计次数..., 耗时总和, 总次数]
+        self.pending = []
+        if out_dir: os.makedirs(out_dir, exist_ok=True)
+
+    def record(self, ev):
+        key = (ev["kind"], ev["op"])
+        with self.lock:
+            self.calls[key + (ev["outcome"],)] += 1
+            self.bytes[key] += ev["bytes"]
+            self.retries[key] += ev["retries"]
+            h = self.hist.setdefault(key, [0] * len(PERF_BUCKETS) + [0.0, 0])
+            for i, b in enumerate(PERF_BUCKETS):
+                if ev["seconds"] <= b: h[i] += 1
+            h[-2] += ev["seconds"]
+            h[-1] += 1
+            if self.out_dir: self.pending.append(ev) # 不导出时不攒明细
+            full = len(self.pending) >= 200
+        if full: self.flush()
+
+    # 进程累计: 每个 (类别, 操作) 一行
+    def summary(self):
+        with self.lock:
+            rows = []
+            for (kind, op), h in self.hist.items():
+                errors = sum(n for (k, o, out), n in self.calls.items() if (k, o) == (kind, op) and out != "ok")
+                rows.append({"类别": kind, "操作": op, "次数": h[-1], "失败": errors, "平均耗时(s)": round(h[-2] / h[-1], 4),
+                             "总耗时(s)": round(h[-2], 3), "字节数": self.bytes[(kind, op)], "重试": self.retries[(kind, op)]})
+        return pd.DataFrame(rows)
+
+    def _prom(self):
+        lab = lambda kind, op: f'app="{self.app}",kind="{kind}",op="{op}"'
+        lines = ["# TYPE app_call_seconds histogram"]
+        for (kind, op), h in self.hist.items():
+            for b, n in zip(PERF_BUCKETS, h):
+                lines.append(f'app_call_seconds_bucket{{{lab(kind, op)},le="{b}"}} {n}')
+            lines.append(f'app_call_seconds_bucket{{{lab(kind, op)},le="+Inf"}} {h[-1]}')
+            lines.append(f"app_call_seconds_sum{{{lab(kind, op)}}} {h[-2]:.4f}")
+            lines.append(f"app_call_seconds_count{{{lab(kind, op)}}} {h[-1]}")
+        lines.append("# TYPE app_calls_total counter")
+        for (kind, op, out), n in self.calls.items():
+            lines.append(f'app_calls_total{{{lab(kind, op)},outcome="{out}"}} {n}')
+        lines.append("# TYPE app_call_bytes_total counter")
+        lines += [f"app_call_bytes_total{{{lab(*k)}}} {n}" for k, n in self.bytes.items()]
+        lines.append("# TYPE app_call_retries_total counter")
+        lines += [f"app_call_retries_total{{{lab(*k)}}} {n}" for k, n in self.retries.items()]
+        return "\n".join(lines) + "\n"
+
+    def flush(self):
+        if not self.out_dir: return
+        with self.lock:
+            pending, self.pending = self.pending, []
+            text = self._prom()
+        try:
+            path = os.path.join(self.out_dir, f"perf_{self.app}.jsonl")
+            if os.path.exists(path) and os.path.getsize(path) > PERF_JSONL_BYTES: os.replace(path, path + ".1")
+            with open(path, "a", encoding="utf-8") as f:
+                for ev in pending: f.write(json.dumps(ev, ensure_ascii=False) + "\n")
+            with open(os.path.join(self.out_dir, f"perf_{self.app}.prom"), "w", encoding="utf-8") as f:
+                f.write(text)
+        except: pass
+
+PERF = None # 进程累计，应用每次 rerun 开头调 start_perf(应用名)，第一次时建好
+
+def start_perf(app, out_dir=PERF_DIR):
+    global PERF
+    if PERF is None: PERF = PerfRecorder(app, out_dir)
+    if get_script_run_ctx(suppress_warning=True): st.session_state["perf_run"] = {"t0": time.perf_counter(), "events": []}
+    return PERF
+
+# 定时重跑的片段 (st.fragment(run_every=...)) 单独重跑时脚本开头不执行，在片段开头调一下，本次明细从这里重新记
+def start_fragment_perf():
+    ctx = get_script_run_ctx(suppress_warning=True)
+    if ctx and ctx.fragment_ids_this_run: st.session_state["perf_run"] = {"t0": time.perf_counter(), "events": []}
+
+# 本次 rerun 的明细；后台线程 (行情刷新、写队列、镜像等) 没有脚本上下文，只记进程累计
+def current_run():
+    if get_script_run_ctx(suppress_warning=True) is None: return None
+    return st.session_state.get("perf_run")
+
+# 用法: with perf("sheets", "batch_get", "Users") as ev: ... ev["bytes"] = ...
+# 代码块里抛异常记为 error；正常结束但结果不对的，自己把 ev["outcome"] 改掉
+@contextmanager
+def perf(kind, op, target=""):
+    ev = {"app": PERF.app if PERF else "", "kind": kind, "op": op, "target": target, "outcome": "ok", "bytes": 0, "retries": 0}
+    t = time.perf_counter()
+    try:
+        yield ev
+    except:
+        ev["outcome"] = "error"
+        raise
+    finally:
+        ev["seconds"] = round(time.perf_counter() - t, 4)
+        run = current_run()
+        ev["offset"] = round(t - run["t0"], 4) if run else None
+        ev["ts"] = round(time.time(), 3)
+        if run:
+            run["events"].append(ev)
+            del run["events"][:-PERF_RUN_EVENTS]
+        if PERF: PERF.record(ev) # 没调过 start_perf (比如测试里直接用存储后端) 只计时
+
+# 性能面板: 本次 rerun 的瀑布图 + 进程累计
+def render_perf_panel():
+    import altair as alt
+    run = current_run()
+    if run and run["events"]:
+        ev = pd.DataFrame(run["events"])
+        ev["end"] = ev["offset"] + ev["seconds"]
+        ev["label"] = [f"{i:02d} {k}.{o} {t}".strip() for i, (k, o, t) in enumerate(zip(ev["kind"], ev["op"], ev["target"]))]
+        chart = alt.Chart(ev).mark_bar().encode(
+            x=alt.X("offset:Q", title="开始 (s)"), x2="end:Q",
+            y=alt.Y("label:N", sort=None, title=None), color="kind:N",
+            tooltip=["kind", "op", "target", "seconds", "bytes", "outcome", "retries"],
+        )
+        st.altair_chart(chart, use_container_width=True)
+        st.caption(f"本次 rerun: {len(ev)} 次调用，外部调用合计 {ev.loc[ev['kind'] != 'cpu', 'seconds'].sum():.3f}s")
+    st.markdown("**进程累计**")
+    st.dataframe(PERF.summary(), use_container_width=True, hide_index=True)
+
+# ================= 2. 差异写入 =================
+def df_to_rows(df):
+    return [[str(c) for c in df.columns]] + df.astype(str).values.tolist()
+
+# 连续的整数合并成区间 [(起, 止), ...]
+def _runs(nums):
+    runs = []
+    for n in nums:
+        if runs and n == runs[-1][1] + 1: runs[-1][1] = n
+        else: runs.append([n, n])
+    return runs
+
+# 表格 index 里开头那段 0..n_old-1 内递增的标签 = 快照里保留下来的原有行，其余都当新增行
+def _kept_rows(index, n_old):
+    kept = []
+    for lab in index:
+        if not isinstance(lab, (int, np.integer)) or not (0 <= lab < n_old) or (kept and lab <= kept[-1]): break
+        kept.append(int(lab))
+    return kept
+
+# append_rows 的返回里实际写到的起始行 (从 1 起)；表格按它检测到的表尾追加，不一定接在快照后面
+# (别的副本刚追加过、或者表中间有整行空白时表尾会提前)，对不上就说明快照和表格的行号错开了
+def appended_at(resp):
+    try: return gspread.utils.a1_to_rowcol(resp["updates"]["updatedRange"].split("!")[-1].split(":")[0])[0]
+    except: return None
+
+# 差异写入: 删除的行按区间一次删掉，改动的单元格一次 batch_update，新增行一次 append_rows
+# 全程不 clear，别人同时读表不会读到空表；传入埋点 ev 时顺带记下提交的字节数
+# 整行空白的行不写 (会让表格检测到的表尾提前，之后的追加错位)
+# 返回写入后的内容；新增行没有接在 old 后面时返回 None，快照不再可信
+def write_diff(ws, old, df, ev=None):
+    df = df[df.astype(str).ne("").any(axis=1)]
+    new = df_to_rows(df)
+    header, rows = (old[0], old[1:]) if old else ([], [])
+    kept = _kept_rows(df.index, len(rows))
+    removed = sorted(set(range(len(rows))) - set(kept))
+    if removed:
+        reqs = [{"deleteDimension": {"range": {"sheetId": ws.id, "dimension": "ROWS", "startIndex": a + 1, "endIndex": b + 2}}}
+                for a, b in reversed(_runs(removed))]
+        ws.spreadsheet.batch_update({"requests": reqs})
+
+    base = [header] + [rows[k] for k in kept]
+    updates = []
+    for r, (a, b) in enumerate(zip(base, new)):
+        width = max(len(a), len(b))
+        a = a + [""] * (width - len(a))
+        b = b + [""] * (width - len(b))
+        for c0, c1 in _runs([c for c in range(width) if a[c] != b[c]]):
+            rng = f"{gspread.utils.rowcol_to_a1(r + 1, c0 + 1)}:{gspread.utils.rowcol_to_a1(r + 1, c1 + 1)}"
+            updates.append({"range": rng, "values": [b[c0:c1 + 1]]})
+    if updates: ws.batch_update(updates)
+
+    at = len(base) + 1
+    if len(new) > len(base): at = appended_at(ws.append_rows(new[len(base):], table_range="A1"))
+    if ev is not None:
+        ev["bytes"] = len(json.dumps([updates, new[len(base):]], ensure_ascii=False).encode("utf-8"))
+    return new if at == len(base) + 1 else None
+
+# ================= 3. 存储后端 =================
+# 读写都经过 STORE: 读一张/多张表、差异保存、追加行、列出表、删除表，表的内容一律是含表头的二维字符串数组
+# SheetsStore 直连谷歌表格；SQLiteStore 存本地文件 (WAL，写操作都在事务里)，可在后台镜像回谷歌表格
+# 用哪种在 secrets 里配 (应用里用 open_store 建一次)，不配就是谷歌表格:
+#   [storage]
+#   backend = "sqlite"
+#   path = "xxx.db"
+#   mirror = true
+class SheetsStore:
+    def __init__(self, sh):
+        self.sh = sh
+        self.snaps = {} # 快照: 每个工作表最近一次读到/写入的内容 (含表头)，保存时只提交和它的差异
+        self.writes = Counter() # 每张表的写入计数: 开始写和写完各 +1 (奇数表示正在写)
+        self.lock = threading.Lock()
+        self.seen = None # 最近一次看到的文件修改时间
+        self.rev = 0
+
+    # 写入期间标记这张表，和它重叠的读不会把写之前的内容当成快照
+    @contextmanager
+    def _writing(self, *tabs):
+        with self.lock:
+            for t in tabs: self.writes[t] += 1
+        try: yield
+        finally:
+            with self.lock:
+                for t in tabs: self.writes[t] += 1
+
+    # 开始读之前记下写入计数，读完交给 _snap 核对
+    def write_marks(self):
+        with self.lock:
+            return dict(self.writes)
+
+    # 读到的内容记为快照: 读的过程中这张表有写入 (计数变了或正在写) 就丢掉快照，下次保存重读
+    def _snap(self, tab, raw, mark):
+        with self.lock:
+            if self.writes[tab] == mark and mark % 2 == 0: self.snaps[tab] = [list(r) for r in raw]
+            else: self.snaps.pop(tab, None)
+
+    # 表格没有单表的修订号，只能查整个文件的修改时间 (Drive API)，变了就当所有表都可能被别人改过
+    # 自己写完会立刻记下新的修改时间，不算外部改动 (这之间别人恰好也写了的话，要等下次修改或手动刷新才看到)
+    def versions(self):
+        with perf("sheets", "probe"):
+            stamp = self.sh.get_lastUpdateTime()
+        if stamp != self.seen:
+            self.seen = stamp
+            self.rev += 1
+        return {"*": self.rev}
+
+    def _absorb(self):
+        if self.seen is None: return # 没探测过 (应用不用 versions) 就不必多查一次
+        try: self.seen = self.sh.get_lastUpdateTime()
+        except: self.seen = None
+
+    # 后端的修改标记 (别的副本探测到的是同一个值)，给共享缓存判断有没有人直接改过表格
+    def token(self):
+        return self.seen
+
+    # 从共享缓存拿到的表内容 (别的副本刚读到的) 当作快照，保存时照样只写差异
+    # marks 是开始读之前的 write_marks()，这之后本进程写过这张表的就不用
+    def adopt(self, tab, raw, marks=None):
+        self._snap(tab, raw, (self.write_marks() if marks is None else marks).get(tab, 0))
+
+    def list_tabs(self):
+        with perf("sheets", "list_tabs"):
+            return [ws.title for ws in self.sh.worksheets()]
+
+    # 一次 values_batch_get 读回多张表 (返回 {表名: 原始二维数组})
+    # 有表不存在时整批请求会失败，这时补建缺的表再读一次
+    def load_tabs(self, tab_headers):
+        tabs = list(tab_headers)
+        ranges = [gspread.utils.absolute_range_name(t) for t in tabs]
+        marks = self.write_marks()
+        with perf("sheets", "batch_get", ",".join(tabs)) as ev:
+            try: resp = self.sh.values_batch_get(ranges)
+            except gspread.exceptions.APIError:
+                titles = self.list_tabs()
+                for t in tabs:
+                    if t not in titles: self.sh.add_worksheet(title=t, rows=100, cols=20).update([tab_headers[t]])
+                resp = self.sh.values_batch_get(ranges)
+                ev["retries"] = 1
+            ev["bytes"] = len(json.dumps(resp, ensure_ascii=False).encode("utf-8"))
+        out = {}
+        for t, vr in zip(tabs, resp.get("valueRanges", [])):
+            values = vr.get("values", [])
+            out[t] = gspread.utils.fill_gaps(values) if values else []
+            self._snap(t, out[t], marks.get(t, 0))
+        return out
+
+    def load_tab(self, tab):
+        marks = self.write_marks()
+        with perf("sheets", "get", tab) as ev:
+            raw = self.sh.worksheet(tab).get_all_values()
+            ev["bytes"] = len(json.dumps(raw, ensure_ascii=False).encode("utf-8"))
+        self._snap(tab, raw, marks.get(tab, 0))
+        return raw
+
+    def save_tab(self, tab, df):
+        try: ws = self.sh.worksheet(tab)
+        except gspread.exceptions.WorksheetNotFound: ws = self.sh.add_worksheet(title=tab, rows=100, cols=20)
+        with self._writing(tab):
+            try:
+                with perf("sheets", "write", tab) as ev:
+                    old = self.snaps.get(tab)
+                    if old is None: old = ws.get_all_values()
+                    new = write_diff(ws, old, df, ev)
+                    if new is None: self.snaps.pop(tab, None)
+                    else: self.snaps[tab] = new
+            except:
+                self.snaps.pop(tab, None) # 写到一半失败，快照不再可信
+                raise
+        self._absorb()
+
+    def append_rows(self, tab, rows):
+        with self._writing(tab):
+            with perf("sheets", "append", tab) as ev:
+                ev["bytes"] = len(json.dumps(rows, ensure_ascii=False).encode("utf-8"))
+                resp = self.sh.worksheet(tab).append_rows(rows, table_range="A1")
+            snap = self.snaps.get(tab)
+            if snap is not None and appended_at(resp) == len(snap) + 1: snap.extend(rows)
+            else: self.snaps.pop(tab, None)
+        self._absorb()
+
+    # 单行条件更新: 按主键列找到这一行，expect 里的列都还是原值才写，只改 changes 这几格
+    # 返回 (是否写入, 这一行当前的值)；主键列和要核对的列一次按列读回，不读整表
+    # 表格没有事务，核对到写入之间还有一个很短的窗口
+    def update_row(self, tab, key_col, key, changes, expect=None):
+        return self.update_rows(tab, key_col, [(key, changes, expect)])[0]
+
+    # 多行条件更新: items 是 [(主键, changes, expect)]，一次读回要核对的列、一次 batch_update 写出所有通过核对的格子
+    def update_rows(self, tab, key_col, items):
+        with self._writing(tab):
+            ws = self.sh.worksheet(tab)
+            snap = self.snaps.get(tab)
+            header = snap[0] if snap else ws.row_values(1)
+            cols = list(dict.fromkeys([key_col] + [c for _, _, expect in items for c in (expect or {})]))
+            letter = lambda c: gspread.utils.rowcol_to_a1(1, header.index(c) + 1)[:-1]
+            out, updates, done = [], [], []
+            with perf("sheets", "update_rows", tab) as ev:
+                resp = self.sh.values_batch_get([gspread.utils.absolute_range_name(tab, f"{letter(c)}:{letter(c)}") for c in cols],
+                                                params={"majorDimension": "COLUMNS"})
+                vals = [(vr.get("values") or [[]])[0] for vr in resp.get("valueRanges", [])]
+                where = {}
+                for r, k in enumerate(vals[0][1:], 1): where.setdefault(k, r)
+                for key, changes, expect in items:
+                    r = where.get(key)
+                    if r is None:
+                        out.append((False, None))
+                        continue
+                    cur = {c: (v[r] if r < len(v) else "") for c, v in zip(cols, vals)}
+                    if any(cur[c] != str(v) for c, v in (expect or {}).items()):
+                        out.append((False, cur))
+                        continue
+                    updates += [{"range": gspread.utils.rowcol_to_a1(r + 1, header.index(c) + 1), "values": [[str(v)]]} for c, v in changes.items()]
+                    for c, v in changes.items(): # 同一行后面的条目要核对的是这次写入后的值
+                        if c in cols:
+                            col = vals[cols.index(c)]
+                            col += [""] * (r + 1 - len(col))
+                            col[r] = str(v)
+                    done.append((r, key, changes))
+                    out.append((True, {**cur, **{c: str(v) for c, v in changes.items()}}))
+                if updates: ws.batch_update(updates)
+                ev["bytes"] = len(json.dumps(updates, ensure_ascii=False).encode("utf-8"))
+            # 快照里同一位置是同一行就顺手改掉，对不上说明快照旧了，丢掉下次保存重读
+            k = header.index(key_col)
+            for r, key, changes in done:
+                if snap and r < len(snap) and len(snap[r]) > k and snap[r][k] == key:
+                    for c, v in changes.items():
+                        i = header.index(c)
+                        snap[r] += [""] * (i + 1 - len(snap[r]))
+                        snap[r][i] = str(v)
+                else:
+                    self.snaps.pop(tab, None)
+                    snap = None
+        if done: self._absorb()
+        return out
+
+    def delete_tab(self, tab):
+        with self._writing(tab):
+            with perf("sheets", "delete", tab):
+                self.sh.del_worksheet(self.sh.worksheet(tab))
+            self.snaps.pop(tab, None)
+        self._absorb()
+
+    # 建一张只有表头的新表 (不留快照，之后 append_rows 也不会在内存里攒整表)
+    def create_tab(self, tab, header):
+        with self._writing(tab), perf("sheets", "create", tab):
+            self.sh.add_worksheet(title=tab, rows=100, cols=max(len(header), 1)).update([header])
+        self._absorb()
+
+    # 用 src 整表替换 dst: 删 dst 和把 src 改名成 dst 放在同一个 batch_update 里，要么都成功要么都不做
+    def swap_tab(self, src, dst):
+        ws = self.sh.worksheet(src)
+        props = {"sheetId": ws.id, "title": dst}
+        reqs = []
+        try:
+            old = self.sh.worksheet(dst)
+            reqs.append({"deleteSheet": {"sheetId": old.id}})
+            props["index"] = old.index # 留在原来的位置
+        except gspread.exceptions.WorksheetNotFound: pass
+        reqs.append({"updateSheetProperties": {"properties": props, "fields": ",".join(k for k in props if k != "sheetId")}})
+        with self._writing(src, dst):
+            with perf("sheets", "swap", dst):
+                self.sh.batch_update({"requests": reqs})
+            self.snaps.pop(src, None)
+            self.snaps.pop(dst, None)
+        self._absorb()
+
+# 每张表一个 SQLite 表: _row 保持行序，c0..cN 按位置存各列 (表头可以是任意文字，存在 _tabs 里)
+# _tabs.version 每次写入 +1，synced 是已经镜像到谷歌表格的版本；删除的表 header 置空，等镜像删掉后再移除
+class SQLiteStore:
+    def __init__(self, path, indexes=None):
+        self.indexes = indexes or {} # {表名: [要建索引的列名]}
+        self.mirror = None
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS _tabs (tab TEXT PRIMARY KEY, header TEXT, version INTEGER NOT NULL DEFAULT 0, synced INTEGER NOT NULL DEFAULT 0)")
+
+    @staticmethod
+    def _q(name):
+        return '"' + name.replace('"', '""') + '"'
+
+    # 写事务: BEGIN IMMEDIATE 先拿写锁，多个进程同时写会排队而不是互相覆盖
+    @contextmanager
+    def _write(self):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+                self.conn.execute("COMMIT")
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def _header(self, tab):
+        row = self.conn.execute("SELECT header FROM _tabs WHERE tab = ?", (tab,)).fetchone()
+        return json.loads(row[0]) if row and row[0] is not None else None
+
+    def _read(self, tab):
+        header = self._header(tab)
+        if not header: return []
+        cols = ", ".join(f"c{i}" for i in range(len(header)))
+        rows = self.conn.execute(f"SELECT {cols} FROM {self._q('t_' + tab)} ORDER BY _row").fetchall()
+        return [header] + [list(r) for r in rows]
+
+    def _insert(self, tab, width, rows):
+        if not rows or not width: return
+        rows = [([str(v) for v in r] + [""] * width)[:width] for r in rows]
+        marks = ", ".join("?" * width)
+        cols = ", ".join(f"c{i}" for i in range(width))
+        self.conn.executemany(f"INSERT INTO {self._q('t_' + tab)} ({cols}) VALUES ({marks})", rows)
+
+    def _bump(self, tab, header):
+        self.conn.execute(
+            "INSERT INTO _tabs (tab, header, version) VALUES (?, ?, 1) "
+            "ON CONFLICT(tab) DO UPDATE SET header = excluded.header, version = version + 1",
+            (tab, None if header is None else json.dumps(header, ensure_ascii=False)))
+
+    # 整表替换: 表头没变只清空重写，表头变了连索引一起重建
+    def _replace(self, tab, header, rows):
+        table = self._q("t_" + tab)
+        if self._header(tab) != header:
+            self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+            self.conn.execute(f"CREATE TABLE {table} (_row INTEGER PRIMARY KEY{''.join(f', c{i} TEXT' for i in range(len(header)))})")
+            for c in self.indexes.get(tab, []):
+                if c in header:
+                    self.conn.execute(f"CREATE INDEX {self._q(f'ix_{tab}_{c}')} ON {table} (c{header.index(c)})")
+        else:
+            self.conn.execute(f"DELETE FROM {table}")
+        self._insert(tab, len(header), rows)
+        self._bump(tab, header)
+
+    def list_tabs(self):
+        with perf("sqlite", "list_tabs"), self.lock:
+            return [r[0] for r in self.conn.execute("SELECT tab FROM _tabs WHERE header IS NOT NULL ORDER BY rowid")]
+
+    # 多张表在同一个读事务里读，拿到的是同一时刻的一致快照；不存在的表按给定表头建空表
+    def load_tabs(self, tab_headers):
+        with perf("sqlite", "batch_get", ",".join(tab_headers)), self.lock:
+            missing = [t for t in tab_headers if self._header(t) is None]
+            if missing:
+                self.conn.execute("BEGIN IMMEDIATE")
+                try:
+                    for t in missing:
+                        if self._header(t) is None: self._replace(t, list(tab_headers[t]), [])
+                except:
+                    self.conn.execute("ROLLBACK")
+                    raise
+            else:
+                self.conn.execute("BEGIN")
+            try: return {t: self._read(t) for t in tab_headers}
+            finally: self.conn.execute("COMMIT")
+
+    def load_tab(self, tab):
+        with perf("sqlite", "get", tab), self.lock:
+            return self._read(tab)
+
+    def save_tab(self, tab, df):
+        rows = df_to_rows(df)
+        with perf("sqlite", "write", tab), self._write():
+            self._replace(tab, rows[0], rows[1:])
+
+    def append_rows(self, tab, rows):
+        with perf("sqlite", "append", tab), self._write():
+            header = self._header(tab)
+            if header is None: raise KeyError(tab)
+            self._insert(tab, len(header), rows)
+            self._bump(tab, header)
+
+    # 单行/多行条件更新 (同 SheetsStore)，核对和写入在同一个写事务里
+    def update_row(self, tab, key_col, key, changes, expect=None):
+        return self.update_rows(tab, key_col, [(key, changes, expect)])[0]
+
+    def update_rows(self, tab, key_col, items):
+        with perf("sqlite", "update_rows", tab), self._write():
+            header = self._header(tab)
+            if not header: raise KeyError(tab)
+            col = lambda c: f"c{header.index(c)}"
+            table = self._q("t_" + tab)
+            out = []
+            for key, changes, expect in items:
+                row = self.conn.execute(f"SELECT _row, {', '.join(col(c) for c in header)} FROM {table} WHERE {col(key_col)} = ? LIMIT 1", (key,)).fetchone()
+                if row is None:
+                    out.append((False, None))
+                    continue
+                cur = dict(zip(header, row[1:]))
+                if any(cur[c] != str(v) for c, v in (expect or {}).items()):
+                    out.append((False, cur))
+                    continue
+                self.conn.execute(f"UPDATE {table} SET {', '.join(col(c) + ' = ?' for c in changes)} WHERE _row = ?",
+                                  [str(v) for v in changes.values()] + [row[0]])
+                out.append((True, {**cur, **{c: str(v) for c, v in changes.items()}}))
+            if any(ok for ok, _ in out): self._bump(tab, header)
+            return out
+
+    def delete_tab(self, tab):
+        with perf("sqlite", "delete", tab), self._write():
+            self.conn.execute(f"DROP TABLE IF EXISTS {self._q('t_' + tab)}")
+            self._bump(tab, None)
+
+    def create_tab(self, tab, header):
+        with perf("sqlite", "create", tab), self._write():
+            self._replace(tab, list(header), [])
+
+    # 用 src 整表替换 dst，在一个事务里完成
+    def swap_tab(self, src, dst):
+        with perf("sqlite", "swap", dst), self._write():
+            header = self._header(src)
+            if header is None: raise KeyError(src)
+            self.conn.execute(f"DROP TABLE IF EXISTS {self._q('t_' + dst)}")
+            self.conn.execute(f"ALTER TABLE {self._q('t_' + src)} RENAME TO {self._q('t_' + dst)}")
+            self._bump(dst, header)
+            self._bump(src, None)
+
+    # 每张表的修订号 (所有进程共用一个库，别的进程写过也能看到)
+    def versions(self):
+        with perf("sqlite", "probe"), self.lock:
+            return dict(self.conn.execute("SELECT tab, version FROM _tabs WHERE header IS NOT NULL").fetchall())
+
+    def token(self):
+        return json.dumps(sorted(self.versions().items()), ensure_ascii=False)
+
+    # 没有快照，保存是整表替换
+    def write_marks(self): return {}
+    def adopt(self, tab, raw, marks=None): pass
+
+    # 镜像用: 还没同步到谷歌表格的表 [(表名, 版本, 是否已删除)]
+    def dirty(self):
+        with self.lock:
+            return [(t, v, h is None) for t, v, h in self.conn.execute("SELECT tab, version, header FROM _tabs WHERE version > synced")]
+
+    def mark_synced(self, tab, version):
+        with self._write():
+            self.conn.execute("UPDATE _tabs SET synced = ? WHERE tab = ? AND synced < ?", (version, tab, version))
+            self.conn.execute("DELETE FROM _tabs WHERE tab = ? AND header IS NULL AND version = ?", (tab, version))
+
+# 后台镜像: 每隔 interval 秒把 SQLite 里改过的表写回谷歌表格
+# 每次先重读表格再写差异，别的进程/人动过表格也不会写错位置
+class StoreMirror:
+    def __init__(self, store, sheets, interval=60):
+        self.store = store
+        self.sheets = sheets
+        self.interval = interval
+        self.last_sync = 0.0
+        self.last_error = ""
+        threading.Thread(target=self._loop, name="store-mirror", daemon=True).start()
+
+    def sync(self):
+        for tab, version, deleted in self.store.dirty():
+            if deleted:
+                try: self.sheets.delete_tab(tab)
+                except gspread.exceptions.WorksheetNotFound: pass
+            else:
+                raw = self.store.load_tab(tab)
+                self.sheets.snaps.pop(tab, None)
+                self.sheets.save_tab(tab, pd.DataFrame(raw[1:], columns=raw[0]) if raw else pd.DataFrame())
+            self.store.mark_synced(tab, version)
+        self.last_sync = time.time()
+
+    def _loop(self):
+        while True:
+            try:
+                self.sync()
+                self.last_error = ""
+            except Exception as e: self.last_error = str(e)
+            time.sleep(self.interval)
+
+def store_config(default_path):
+    try: cfg = dict(st.secrets.get("storage", {}))
+    except: cfg = {}
+    return {"backend": "sheets", "path": default_path, "mirror": False, **cfg}
+
+# 按 secrets 打开后端，connect() 返回谷歌表格连接 (连不上返回 None)
+# SQLite 库是新建的时候先从谷歌表格导入一次 (seed_tabs 为 None 表示导入所有表)
+def open_store(connect, default_path, indexes=None, seed_tabs=None, mirror_seconds=60):
+    cfg = store_config(default_path)
+    if cfg["backend"] != "sqlite":
+        sh = connect()
+        return SheetsStore(sh) if sh else None
+    # 只有要导入或要镜像时才连谷歌表格，纯本地用不需要凭证
+    sh = connect() if cfg["mirror"] or not os.path.exists(cfg["path"]) else None
+    store = SQLiteStore(cfg["path"], indexes)
+    if sh and not store.list_tabs():
+        sheets = SheetsStore(sh)
+        for t in (seed_tabs if seed_tabs is not None else sheets.list_tabs()):
+            try: raw = sheets.load_tab(t)
+            except gspread.exceptions.WorksheetNotFound: continue
+            store.save_tab(t, pd.DataFrame(raw[1:], columns=raw[0]) if raw else pd.DataFrame())
+        for t, v, _ in store.dirty(): store.mark_synced(t, v)
+    if sh and cfg["mirror"]: store.mirror = StoreMirror(store, SheetsStore(sh), mirror_seconds)
+    return store
+
+# ================= 4. 共享缓存 (多副本) =================
+# 多个 Streamlit 副本共用一层表缓存: 某个副本从后端读到的表按 (表名, 版本) 放进共享层，其他副本直接拿，不再各读一遍
+# 任何副本写了表就把这张表的版本 +1 并发一条失效消息，其他副本的监听线程收到后更新版本，下次读就换新的
+# ttl: 条目最长保留多久；poll: 监听失效消息的间隔 (sqlite)、断线重连的间隔 (redis)
+# 不配就不启用 (每个进程只用自己的缓存)，配置:
+#   [shared_cache]
+#   backend = "sqlite"   # 同一台机器上的副本共用一个文件，path = "xxx.db"
+#   backend = "redis"    # 或任何兼容 Redis 协议的服务 (要装 redis 包)，url = "redis://host:6379/0"
+class SQLiteSharedCache:
+    def __init__(self, path, ttl=600, poll=1):
+        self.ttl = ttl
+        self.poll = poll
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS gens (name TEXT PRIMARY KEY, gen INTEGER NOT NULL, seq INTEGER NOT NULL)") # 版本 + 失效消息序号
+        self.conn.execute("CREATE TABLE IF NOT EXISTS entries (tab TEXT PRIMARY KEY, gen INTEGER, star INTEGER, raw TEXT, at REAL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT)")
+        self.gens = {} # 本进程知道的各表版本，监听线程更新
+        self.seq = 0 # 已经收到的最后一条失效消息
+        self._poll()
+        threading.Thread(target=self._listen, name="shared-cache", daemon=True).start()
+
+    @contextmanager
+    def _write(self):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+                self.conn.execute("COMMIT")
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    # 收失效消息: 序号比上次大的就是别的副本新发的
+    def _poll(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT name, gen, seq FROM gens WHERE seq > ?", (self.seq,)).fetchall()
+        for name, gen, seq in rows:
+            self.gens[name] = max(self.gens.get(name, 0), gen)
+            self.seq = max(self.seq, seq)
+
+    def _listen(self):
+        while True:
+            time.sleep(self.poll)
+            try: self._poll()
+            except: pass
+
+    # 表的版本 = (这张表的写入次数, "*" 全部失效的次数)
+    def version(self, tab):
+        return (self.gens.get(tab, 0), self.gens.get("*", 0))
+
+    def get(self, tab, version):
+        with perf("shared", "get", tab) as ev, self.lock:
+            row = self.conn.execute("SELECT raw FROM entries WHERE tab = ? AND gen = ? AND star = ? AND at > ?",
+                                    (tab, version[0], version[1], time.time() - self.ttl)).fetchone()
+            if row is None:
+                ev["outcome"] = "miss"
+                return None
+            ev["bytes"] = len(row[0].encode("utf-8"))
+        return json.loads(row[0])
+
+    # 每张表只留一份，版本旧的不会盖掉新的
+    def put(self, tab, version, raw):
+        data = json.dumps(raw, ensure_ascii=False)
+        with perf("shared", "put", tab) as ev, self._write():
+            ev["bytes"] = len(data.encode("utf-8"))
+            self.conn.execute("INSERT INTO entries (tab, gen, star, raw, at) VALUES (?, ?, ?, ?, ?) "
+                              "ON CONFLICT(tab) DO UPDATE SET gen = excluded.gen, star = excluded.star, raw = excluded.raw, at = excluded.at "
+                              "WHERE excluded.gen >= entries.gen AND excluded.star >= entries.star",
+                              (tab, version[0], version[1], data, time.time()))
+
+    # 写表之后: 这些表的版本 +1 并发失效消息；token 是写完后后端的修改标记 (见 observe)
+    def publish(self, names, token=None):
+        with perf("shared", "publish", ",".join(names)), self._write():
+            seq = self.conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM gens").fetchone()[0]
+            for n in names:
+                self.conn.execute("INSERT INTO gens (name, gen, seq) VALUES (?, 1, ?) ON CONFLICT(name) DO UPDATE SET gen = gen + 1, seq = excluded.seq", (n, seq))
+            if token is not None: self.conn.execute("INSERT OR REPLACE INTO meta (k, v) VALUES ('token', ?)", (token,))
+        self._poll() # 自己发的马上生效
+
+    # 各副本探测到的后端修改标记 (谷歌表格的修改时间等): 和共享层记的不一样说明有人直接改过后端，第一个发现的副本让所有表失效
+    def observe(self, token):
+        with self._write():
+            row = self.conn.execute("SELECT v FROM meta WHERE k = 'token'").fetchone()
+            if row and row[0] == token: return
+            self.conn.execute("INSERT OR REPLACE INTO meta (k, v) VALUES ('token', ?)", (token,))
+        if row: self.publish(["*"])
+
+class RedisSharedCache:
+    def __init__(self, url, prefix, ttl=600, poll=1):
+        self.ttl = ttl
+        self.poll = poll
+        import redis
+        self.r = redis.Redis.from_url(url)
+        self.p = prefix
+        self.gens = {}
+        self._poll()
+        threading.Thread(target=self._listen, name="shared-cache", daemon=True).start()
+
+    @staticmethod
+    def _s(v):
+        return v.decode("utf-8") if isinstance(v, bytes) else v
+
+    def _poll(self):
+        for k, v in self.r.hgetall(f"{self.p}:gens").items():
+            k = self._s(k)
+            self.gens[k] = max(self.gens.get(k, 0), int(v))
+
+    # 订阅失效消息；断线重连后先补一次全量版本，断线期间漏掉的消息也不影响
+    def _listen(self):
+        while True:
+            try:
+                ps = self.r.pubsub(ignore_subscribe_messages=True)
+                ps.subscribe(f"{self.p}:inval")
+                self._poll()
+                for m in ps.listen():
+                    for k, v in json.loads(m["data"]).items(): self.gens[k] = max(self.gens.get(k, 0), int(v))
+            except: time.sleep(self.poll)
+
+    def version(self, tab):
+        return (self.gens.get(tab, 0), self.gens.get("*", 0))
+
+    def _key(self, tab, version):
+        return f"{self.p}:tab:{tab}:{version[0]}:{version[1]}"
+
+    def get(self, tab, version):
+        with perf("shared", "get", tab) as ev:
+            data = self.r.get(self._key(tab, version))
+            if data is None:
+                ev["outcome"] = "miss"
+                return None
+            ev["bytes"] = len(data)
+        return json.loads(data)
+
+    # 键里带版本，旧版本的键没人再读，到 ttl 自动过期
+    def put(self, tab, version, raw):
+        data = json.dumps(raw, ensure_ascii=False).encode("utf-8")
+        with perf("shared", "put", tab) as ev:
+            ev["bytes"] = len(data)
+            self.r.set(self._key(tab, version), data, ex=self.ttl)
+
+    def publish(self, names, token=None):
+        with perf("shared", "publish", ",".join(names)):
+            pipe = self.r.pipeline()
+            for n in names: pipe.hincrby(f"{self.p}:gens", n, 1)
+            if token is not None: pipe.set(f"{self.p}:token", token)
+            gens = dict(zip(names, pipe.execute()))
+            self.r.publish(f"{self.p}:inval", json.dumps(gens, ensure_ascii=False))
+        for k, v in gens.items(): self.gens[k] = max(self.gens.get(k, 0), int(v))
+
+    def observe(self, token):
+        old = self.r.set(f"{self.p}:token", token, get=True)
+        if old is not None and self._s(old) != token: self.publish(["*"])
+
+def shared_cache_config():
+    try: return dict(st.secrets.get("shared_cache", {}))
+    except: return {}
+
+# 按 secrets 打开共享层；没配或连不上返回 None，各进程退回自己的缓存
+def open_shared_cache(default_path, prefix, ttl=600, poll=1):
+    cfg = shared_cache_config()
+    try:
+        if cfg.get("backend") == "sqlite": return SQLiteSharedCache(cfg.get("path", default_path), ttl, poll)
+        if cfg.get("backend") == "redis": return RedisSharedCache(cfg["url"], cfg.get("prefix", prefix), ttl, poll)
+    except: pass
+    return None
+
+# 经过共享层读表: 先按 (表名, 版本) 从共享层拿 (拿到的当作后端快照)，没有的一次批量从后端读回再放进共享层
+# tab_headers: {表名: 表头}，表头非空的表不存在时按它建表；只差一张、又不用建表时单独读
+# versions: 各表在共享层里的版本，默认取当前的；shared 为 None 时直接读后端
+# marks: 读之前记下的写入计数 (默认现在记)，读的过程中本进程写过的表不拿共享层的内容当快照；
+# 调用方先按版本判断哪些表要重读的，要在判断之前记下传进来
+def read_through(store, shared, tab_headers, versions=None, marks=None):
+    if marks is None: marks = store.write_marks()
+    if versions is None: versions = {t: shared.version(t) if shared else None for t in tab_headers}
+    out = {}
+    for t in tab_headers:
+        try: raw = shared.get(t, versions[t]) if shared else None
+        except: raw = None
+        if raw is None: continue
+        store.adopt(t, raw, marks)
+        out[t] = raw
+    missing = {t: h for t, h in tab_headers.items() if t not in out}
+    if missing:
+        if len(missing) > 1 or any(missing.values()): fresh = store.load_tabs(missing)
+        else: fresh = {t: store.load_tab(t) for t in missing}
+        for t in missing:
+            try:
+                if shared: shared.put(t, versions[t], fresh[t])
+            except: pass
+        out.update(fresh)
+    return out
+
+# ================= 5. 后台写队列 =================
+# 写操作 (整表保存/追加行/单行条件更新) 先进队列马上返回，不再挡着页面转圈
+# 读表时把还没写出去的改动叠加在缓存上，自己刚改的马上就能看到
+# 后台线程按表合并排队的改动: 连着的追加并成一次 append，连着的条件更新并成一次 batch_update，
+# 整表保存会吸收排在它后面的改动一起写；失败按 backoff 秒起翻倍退避重试，重试 retries 次还不行算失败
+# 每批写完调 on_written(表名, 是否建了新表)，返回这张表在本进程的新版本 (读缓存用它判断是否已包含这批改动)
+# 同一张表的改动按提交顺序写，after 里的改动写成功之后才写这一条
+# 整表保存是在叠加了排队改动的内容上做的，自动依赖这张表还在排队的改动: 前面的失败了它也不写，界面显示的和实际写出的一致
+# 失败的整表保存在这张表后来又写出过改动之后不能再重试 (重试会把旧内容整表写回去，盖掉后来的改动)
+
+# 把一条改动叠加到原始二维数组上 (不改原数组)，返回 (新数组, 是否生效)；条件更新核对不过算不生效
+def apply_op(raw, op):
+    if op["kind"] == "save": return df_to_rows(op["df"]), True
+    if op["kind"] == "append": return (raw or [list(op["header"])]) + [list(r) for r in op["rows"]], True
+    if not raw or op["key_col"] not in raw[0]: return raw, False
+    header = raw[0]
+    k = header.index(op["key_col"])
+    for i, r in enumerate(raw[1:], 1):
+        if len(r) <= k or r[k] != op["key"]: continue
+        cur = dict(zip(header, list(r) + [""] * (len(header) - len(r))))
+        changes = op["changes"]
+        if any(cur.get(c) != str(v) for c, v in op["expect"].items()):
+            rb = op["rebase"](cur) if op.get("rebase") else None
+            if not rb: return raw, False
+            changes = rb[0]
+        return raw[:i] + [[str(changes.get(c, cur[c])) for c in header]] + raw[i + 1:], True
+    return raw, False
+
+class SaveQueue:
+    def __init__(self, store, on_written, retries=5, backoff=1.0, backoff_max=60, keep=1000):
+        self.store = store
+        self.on_written = on_written
+        self.retries, self.backoff, self.backoff_max, self.keep = retries, backoff, backoff_max, keep
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.ops = [] # 排队中 (含正在写) 的改动，按提交顺序
+        self.landed = [] # 已经写出、但本进程的缓存可能还没重读的改动，读的时候继续叠加
+        self.status = {} # 改动编号 -> {"label", "state": pending/synced/failed, "error", "tries"}
+        self.failed = {} # 失败的改动，可以手动重试
+        threading.Thread(target=self._loop, name="save-queue", daemon=True).start()
+
+    def submit(self, tab, kind, label, after=(), **data):
+        op = {"id": uuid.uuid4().hex[:12], "tab": tab, "kind": kind, "after": list(after), "tries": 0, "next": 0.0, "busy": False, **data}
+        with self.lock:
+            if kind == "save": op["after"] += [o["id"] for o in self.ops if o["tab"] == tab and o["id"] not in op["after"]]
+            self.ops.append(op)
+            self.status[op["id"]] = {"label": label, "state": "pending", "error": "", "tries": 0, "retry": True}
+            while len(self.status) > self.keep: self.status.pop(next(iter(self.status)))
+        self.wake.set()
+        return op["id"]
+
+    # 这张表还没写完的改动编号 (landed=True 时也算上已写出但缓存还没追上的)
+    def pending(self, tab, landed=False):
+        with self.lock:
+            return tuple(op["id"] for op in (self.landed if landed else []) + self.ops if op["tab"] == tab)
+
+    # 排队中的新建表 (写出之前表格列表里还没有)
+    def new_tabs(self, titles):
+        with self.lock:
+            return list(dict.fromkeys(op["tab"] for op in self.ops if op.get("new") and op["tab"] not in titles))
+
+    # 读表时叠加: stamp 是 raw 的缓存戳，缓存已经是写入之后读的就不再叠加已写出的改动
+    def overlay(self, tab, raw, stamp):
+        with self.lock:
+            # 写出超过一分钟的早就被重读过了，不再留着
+            self.landed = [op for op in self.landed if op["at"] > time.time() - 60 and (op["tab"] != tab or stamp is None or stamp[0] < op["landed"])]
+            ops = [op for op in self.landed + self.ops if op["tab"] == tab]
+        for op in ops: raw = apply_op(raw, op)[0]
+        return raw
+
+    def states(self, ids):
+        with self.lock:
+            return {i: dict(self.status[i]) for i in ids if i in self.status}
+
+    # 表被删了: 还没开始写的改动作废
+    def discard(self, tab, reason):
+        with self.lock:
+            for op in [op for op in self.ops if op["tab"] == tab and not op["busy"]]:
+                self.ops.remove(op)
+                self.status[op["id"]].update(state="failed", error=reason, retry=False)
+
+    # 重试时连同因为它失败而没执行的改动一起重新排队
+    def retry(self, op_id):
+        with self.lock:
+            if op_id not in self.failed: return
+            ids = [op_id]
+            for op in list(self.failed.values()):
+                if any(d in ids for d in op["after"]): ids.append(op["id"])
+            for i in ids:
+                op = self.failed.pop(i)
+                op.update(tries=0, next=0.0, busy=False)
+                self.ops.append(op)
+                self.status[i].update(state="pending", error="", tries=0)
+        self.wake.set()
+
+    # 等这张表排队的改动都写完 (导入之类直接改后端的操作之前用)
+    def drain(self, tab, timeout=30):
+        end = time.time() + timeout
+        while self.pending(tab):
+            if time.time() > end: raise TimeoutError("这张表还有改动没同步完，请稍后再试")
+            time.sleep(0.2)
+
+    def _fail(self, op, error, retry=True):
+        self.ops.remove(op)
+        self.status[op["id"]].update(state="failed", error=error, retry=retry)
+        if retry:
+            self.failed[op["id"]] = op
+            while len(self.failed) > self.keep: self.failed.pop(next(iter(self.failed)))
+
+    # 取下一批能写的: 按表的先后，每张表从头取到第一条还不能写的为止 (在退避中、或依赖的改动还没写完)
+    def _next_run(self):
+        now = time.time()
+        with self.lock:
+            for tab in dict.fromkeys(op["tab"] for op in self.ops):
+                run = []
+                for op in [op for op in self.ops if op["tab"] == tab]:
+                    # 依赖的改动在同一批里的不用等，一起写、一起成败
+                    deps = [self.status.get(d, {}).get("state", "synced") for d in op["after"] if d not in {o["id"] for o in run}]
+                    if "failed" in deps:
+                        self._fail(op, "前一步没写成功，未执行")
+                        continue
+                    if op["busy"] or op["next"] > now or "pending" in deps: break
+                    if run and run[0]["kind"] != "save" and (op["kind"] != run[0]["kind"] or op.get("key_col") != run[0].get("key_col")): break
+                    run.append(op)
+                if run:
+                    for op in run: op["busy"] = True
+                    return tab, run
+        return None, []
+
+    # 写一批，返回 [(改动, 是否生效)]
+    def _write(self, tab, run):
+        kind = run[0]["kind"]
+        if kind == "save":
+            if len(run) == 1: df, res, extra = run[0]["df"], [(run[0], True)], []
+            else: # 整表保存连同后面的改动一起写: 从最后一次整表保存出发，保留它的行标签 (merge_patch 对齐过的)，差异写入才不会把后面的行整段重写
+                s = max(i for i, op in enumerate(run) if op["kind"] == "save")
+                base = run[s]["df"]
+                raw, res = df_to_rows(base), [(op, True) for op in run[:s + 1]]
+                for op in run[s + 1:]:
+                    raw, ok = apply_op(raw, op)
+                    res.append((op, ok))
+                df = pd.DataFrame(raw[1:len(base) + 1], columns=raw[0], index=base.index)
+                extra = raw[len(base) + 1:] # 后面追加的行另外追加
+            self.store.save_tab(tab, df)
+            if extra: self.store.append_rows(tab, extra)
+            return res
+        if kind == "append":
+            rows = [r for op in run for r in op["rows"]]
+            if run[0].get("new"): self.store.save_tab(tab, pd.DataFrame(rows, columns=run[0]["header"]))
+            else: self.store.append_rows(tab, rows)
+            return [(op, True) for op in run]
+        res = dict(zip((op["id"] for op in run), self.store.update_rows(tab, run[0]["key_col"], [(op["key"], op["changes"], op["expect"]) for op in run])))
+        again = [] # 行变了但还能按新值再试的 (rebase 给出新的 changes/expect)
+        for op in run:
+            ok, cur = res[op["id"]]
+            rb = op["rebase"](cur) if not ok and cur is not None and op.get("rebase") else None
+            if rb:
+                op["changes"], op["expect"] = rb
+                again.append(op)
+        if again: res.update(zip((op["id"] for op in again), self.store.update_rows(tab, run[0]["key_col"], [(op["key"], op["changes"], op["expect"]) for op in again])))
+        return [(op, res[op["id"]][0]) for op in run]
+
+    def _step(self):
+        tab, run = self._next_run()
+        if not run: return False
+        try:
+            res = self._write(tab, run)
+        except Exception as e:
+            with self.lock:
+                for op in run:
+                    op["tries"] += 1
+                    op["busy"] = False
+                    op["next"] = time.time() + min(self.backoff * 2 ** (op["tries"] - 1), self.backoff_max)
+                    self.status[op["id"]].update(tries=op["tries"], error=str(e) or type(e).__name__)
+                    if op["tries"] > self.retries: self._fail(op, str(e) or type(e).__name__)
+            return True
+        landed = self.on_written(tab, any(op.get("new") for op in run))
+        with self.lock:
+            for op, ok in res:
+                if ok:
+                    self.ops.remove(op)
+                    self.landed.append({**op, "landed": landed, "at": time.time()})
+                    self.status[op["id"]].update(state="synced", error="")
+                else: self._fail(op, "已被别人修改或删除，未写入", retry=False)
+            if any(ok for _, ok in res):
+                for op in [op for op in self.failed.values() if op["tab"] == tab and op["kind"] == "save"]:
+                    self.failed.pop(op["id"])
+                    self.status[op["id"]].update(retry=False, error=self.status[op["id"]]["error"] + " (之后这张表已有新的改动写出，不能再重试)")
+        return True
+
+    def _loop(self):
+        while True:
+            self.wake.wait(self.backoff) # 有新改动马上醒，否则定时看看退避到期的
+            self.wake.clear()
+            try:
+                while self._step(): pass
+            except: time.sleep(self.backoff)
+
+# ================= 6. 协作表合并 =================
+# 三方合并: base 是开始编辑时的表，cur 是保存时后端最新的表，state 是编辑器的改动 (改的格子/新增行/删除行)
+# 先把 base 的行对齐到 cur (别人插入/删除的行会错开位置)，再只把自己改过的格子搬过去
+# 别人也改了同一格 (和 base 不同、也和自己的新值不同)、或者行已被别人删掉，算冲突，保留别人的
+# 返回 (合并后的表, 冲突说明列表)；index 保留 cur 的行号，新增行接在后面，差异写入据此只提交改动
+def merge_patch(base, cur, state):
+    b_rows = [tuple(r) for r in base.to_numpy(dtype=str)]
+    c_rows = [tuple(r) for r in cur.reindex(columns=base.columns, fill_value="").to_numpy(dtype=str)]
+    if b_rows == c_rows: pos = dict(zip(range(len(b_rows)), range(len(c_rows))))
+    else:
+        pos = {}
+        for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, b_rows, c_rows, autojunk=False).get_opcodes():
+            if tag == "equal": pos.update(zip(range(i1, i2), range(j1, j2)))
+            # 被别人改过的行: 行数没变就按位置配对，改了几格都不要紧，下面逐格核对冲突
+            elif tag == "replace" and i2 - i1 == j2 - j1: pos.update(zip(range(i1, i2), range(j1, j2)))
+            elif tag == "replace": # 行数也变了: 按顺序配对，至少一半的格子相同才算同一行
+                js = list(range(j1, j2))
+                for i in range(i1, i2):
+                    n, j = max(((sum(x == y for x, y in zip(b_rows[i], c_rows[j])), j) for j in js), key=lambda t: (t[0], -t[1]), default=(0, None))
+                    if j is not None and n * 2 >= len(base.columns):
+                        pos[i] = j
+                        js = [x for x in js if x > j]
+    out = cur.copy()
+    conflicts = []
+    for i, cells in state.get("edited_rows", {}).items():
+        i = int(i)
+        j = pos.get(i)
+        if j is None:
+            conflicts.append(f"第 {i + 1} 行已被别人修改或删除")
+            continue
+        for c, v in cells.items():
+            v = "" if v is None else str(v)
+            if c not in out.columns:
+                conflicts.append(f"第 {i + 1} 行「{c}」列已不存在")
+                continue
+            k = out.columns.get_loc(c)
+            if out.iat[j, k] in (base.at[i, c], v): out.iat[j, k] = v
+            else: conflicts.append(f"第 {i + 1} 行「{c}」已被别人改成 {out.iat[j, k]}")
+    drop = []
+    for i in state.get("deleted_rows", []):
+        j = pos.get(int(i))
+        if j is None: continue # 别人已经删了
+        if c_rows[j] == b_rows[int(i)]: drop.append(out.index[j])
+        else: conflicts.append(f"第 {int(i) + 1} 行删除前已被别人修改，未删除")
+    out = out.drop(index=drop)
+    added = pd.DataFrame([{c: "" if r.get(c) is None else str(r.get(c)) for c in cur.columns} for r in state.get("added_rows", [])],
+                         columns=cur.columns, index=range(len(cur), len(cur) + len(state.get("added_rows", []))))
+    return pd.concat([out, added]), conflicts
@@ -1,14 +1,46 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 import uuid
-import time
+import json
+import re
+import ast
+import importlib.util
+import os
+import sys
+from collections import Counter
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # 仓库根目录: 和 fund.py 共用 sheet_store
+from sheet_store import start_perf, perf, render_perf_panel, open_store, open_shared_cache, read_through, SaveQueue, merge_patch
+EVAL_ENGINE = "numexpr" if importlib.util.find_spec("numexpr") else "python" # 装了就用 numexpr 算公式，没装用 pandas 自带的引擎
 
 # ================= 1. 核心配置 =================
 SCOPE = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
 SHEET_NAME = "Team_Data_Center" 
+SYS_TABS = ["Users", "Tasks", "Assignments", "Permissions", "Formulas"] # 每次进页面都要读的系统表
+FORMULA_COLS = ["table_name", "result_col", "formula"] # 计算器保存的公式，表格保存时对改动的行自动重算
+PERF_APP = "team" # 性能埋点里的应用名
+STORE_DB_PATH = "team_data.db" # 本地存储后端 (secrets 里 storage.backend = "sqlite" 时启用) 的默认路径
+STORE_INDEXES = {"Users": ["uid", "name"], "Tasks": ["id", "date", "user"], "Assignments": ["uid"], "Permissions": ["table_name"]}
+MIRROR_SECONDS = 60 # 本地库镜像回谷歌表格的间隔
+PROBE_SECONDS = 15 # 隔多久探测一次后端各表的修订号 (别的进程写过的表才重读)
+SHARED_DB_PATH = "team_shared.db" # 多副本共享缓存 (secrets 里 shared_cache.backend = "sqlite" 时) 的默认路径
+SHARED_TTL = 600 # 共享缓存条目最长保留多久 (表格被直接改动靠探测发现，不靠过期)
+SHARED_POLL = 1 # 共享缓存监听失效消息的间隔 (sqlite)、断线重连的间隔 (redis)
+IMPORT_CHUNK_ROWS = 2000 # 导入时每次从文件读多少行
+IMPORT_BATCH_BYTES = 1_000_000 # 导入时每次写入暂存表的数据量上限 (远低于表格接口的单次请求限制)
+IMPORT_SUFFIX = "__导入中" # 暂存表名后缀，导入完成后整表换入
+PAGE_ROWS = 50 # 协作表每页显示多少行 (只把这一页发给浏览器)
+SAVE_RETRIES = 5 # 后台写失败最多重试几次，间隔从 SAVE_BACKOFF 秒起每次翻倍，最长 SAVE_BACKOFF_MAX 秒
+SAVE_BACKOFF = 1.0
+SAVE_BACKOFF_MAX = 60
+SAVE_POLL = 2 # 有改动在排队时，侧边栏同步状态每隔几秒刷新
+SAVE_SHOWN = 8 # 侧边栏显示本会话最近几条改动
+SAVE_STATUS_KEEP = 1000 # 进程里最多记多少条改动的状态
+TASK_COLS = ["date", "store", "user", "task", "status", "time", "id", "rev"] # id: 稳定的行号，rev: 行版本号 (每次单行修改 +1)
+TASK_HOT_DAYS = 7 # 完成超过这么多天的任务从 Tasks 移到按月的归档表 Tasks_YYYYMM
 
 # 汉化映射
 CN_MAP = {
@@ -24,90 +56,480 @@ def get_beijing_time():
     bj = utc + timedelta(hours=8)
     return bj.strftime("%Y-%m-%d"), bj.strftime("%H:%M")
 
+# ================= 性能埋点 =================
+PERF = start_perf(PERF_APP)
+
 # ================= 2. 谷歌引擎 (缓存加速) =================
 @st.cache_resource
 def get_db_connection():
     try:
-        creds_dict = dict(st.secrets["gcp_service_account"])
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, SCOPE)
-        client = gspread.authorize(creds)
-        sheet = client.open(SHEET_NAME)
+        with perf("sheets", "connect", SHEET_NAME):
+            creds_dict = dict(st.secrets["gcp_service_account"])
+            creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, SCOPE)
+            client = gspread.authorize(creds)
+            sheet = client.open(SHEET_NAME)
         return sheet
     except Exception as e:
         return None
 
-# 缓存表格列表 10分钟
-@st.cache_data(ttl=600)
-def get_all_sheet_titles():
-    sh = get_db_connection()
-    if not sh: return []
+# ================= 存储后端 =================
+# 系统表和用户建的协作表都在这里，表由应用自己建，不预建
+@st.cache_resource(show_spinner=False)
+def get_store():
+    return open_store(get_db_connection, STORE_DB_PATH, STORE_INDEXES, None, MIRROR_SECONDS)
+
+STORE = get_store()
+
+# ================= 共享缓存 (多副本) =================
+# 有人直接改过表格时，探测到的副本会让所有副本的缓存失效 (见 probe_versions)
+@st.cache_resource(show_spinner=False)
+def get_shared_cache():
+    return open_shared_cache(SHARED_DB_PATH, PERF_APP, SHARED_TTL, SHARED_POLL)
+
+SHARED = get_shared_cache()
+
+# 表缓存: {表名: (版本戳, 原始二维数组)}，键 None 存表格列表
+# 版本戳 = (本进程写过几次, 后端修订号, 共享缓存里的版本)，只有这张表的戳变了才重读，写一张表不影响其他表的缓存
+@st.cache_resource
+def get_tab_cache():
+    return {}
+
+@st.cache_resource
+def get_local_versions():
+    return Counter() # 表名 -> 本进程写入次数，"*" 为建表/删表次数
+
+# 元数据探测: 一次拿到后端所有表的修订号 (谷歌表格只有整个文件一个)，PROBE_SECONDS 内复用
+# 配了共享缓存时顺便报告后端的修改标记，有人直接改过表格就让所有副本的缓存失效
+@st.cache_data(ttl=PROBE_SECONDS, show_spinner=False)
+def probe_versions():
+    try: remote = STORE.versions()
+    except: return {}
+    if SHARED:
+        try: SHARED.observe(STORE.token())
+        except: pass
+    return remote
+
+def tab_stamp(tab, remote):
+    return (get_local_versions()[tab], remote.get(tab, remote.get("*", 0)), SHARED.version(tab) if SHARED else None)
+
+# 先从共享缓存按 (表名, 版本) 拿，拿不到返回 None
+def shared_get(tab, version):
+    try: return SHARED.get(tab, version) if SHARED else None
+    except: return None
+
+def shared_put(tab, version, raw):
     try:
-        return [ws.title for ws in sh.worksheets()]
-    except:
-        return []
+        if SHARED: SHARED.put(tab, version, raw)
+    except: pass
+
+def get_all_sheet_titles():
+    if not STORE: return []
+    remote = probe_versions()
+    shared = SHARED.version("#tabs") if SHARED else None
+    stamp = (get_local_versions()["*"], remote.get("*"), tuple(sorted(t for t in remote if t != "*")), shared)
+    cache = get_tab_cache()
+    if cache.get(None, (None,))[0] != stamp:
+        titles = shared_get("#tabs", shared)
+        if titles is None:
+            try: titles = STORE.list_tabs()
+            except: return []
+            shared_put("#tabs", shared, titles)
+        cache[None] = (stamp, titles)
+    return cache[None][1]
+
+# 读多张表: 戳没变的直接用缓存，变了的经过共享缓存重读 (read_through)
+def read_tabs(tabs):
+    marks = STORE.write_marks()
+    remote = probe_versions()
+    cache = get_tab_cache()
+    stamps = {t: tab_stamp(t, remote) for t in tabs}
+    stale = [t for t in tabs if cache.get(t, (None,))[0] != stamps[t]]
+    if stale:
+        fresh = read_through(STORE, SHARED, {t: [] for t in stale}, {t: stamps[t][2] for t in stale}, marks)
+        for t in stale: cache[t] = (stamps[t], fresh[t])
+    return {t: cache[t][1] for t in tabs}
+
+def _to_frame(raw, default_cols):
+    if not raw: return pd.DataFrame(columns=default_cols)
+    headers = raw[0]
+    rows = raw[1:]
+    df = pd.DataFrame(rows, columns=headers) if rows else pd.DataFrame(columns=headers)
+    for c in default_cols:
+        if c not in df.columns: df[c] = ""
+    return df.astype(str)
 
-# 读取数据 10分钟缓存
-@st.cache_data(ttl=600)
+# 读取数据: 系统表一起批量读 (只补读过期的)，其他表单独读
 def load_data(tab_name, default_cols=[]):
-    sh = get_db_connection()
-    if not sh: return pd.DataFrame(columns=default_cols)
+    if not STORE: return _to_frame([], default_cols)
+    titles = get_all_sheet_titles()
+    if tab_name not in titles and not SAVEQ.pending(tab_name): return _to_frame([], default_cols)
+    tabs = [t for t in SYS_TABS if t in titles] if tab_name in SYS_TABS else [tab_name]
     try:
-        worksheet = sh.worksheet(tab_name)
-        raw = worksheet.get_all_values()
-        if not raw: return pd.DataFrame(columns=default_cols)
-        
-        headers = raw[0]
-        rows = raw[1:]
-        df = pd.DataFrame(rows, columns=headers) if rows else pd.DataFrame(columns=headers)
-        
-        for c in default_cols:
-            if c not in df.columns: df[c] = ""
-        return df.astype(str)
-    except:
-        return pd.DataFrame(columns=default_cols)
+        read_tabs(tabs)
+        stamp, raw = get_tab_cache()[tab_name]
+    except: stamp, raw = None, []
+    return _to_frame(SAVEQ.overlay(tab_name, raw, stamp), default_cols)
 
-# 保存数据 (带加载动画)
-def save_data(tab_name, df):
-    sh = get_db_connection()
-    if not sh: return False
-    try:
-        with st.spinner('☁️ 正在同步到云端...'):
-            try:
-                ws = sh.worksheet(tab_name)
-            except:
-                ws = sh.add_worksheet(title=tab_name, rows=100, cols=20)
-            ws.clear()
-            if df.empty:
-                ws.update([df.columns.values.tolist()])
+# 表数据的戳: 缓存戳加上叠加在上面、还没写出去的改动 (戳一样内容就一样)
+def data_stamp(tab_name):
+    stamp = get_tab_cache().get(tab_name, (None,))[0]
+    if stamp is None or not SAVEQ: return stamp
+    return (stamp, SAVEQ.pending(tab_name, landed=True))
+
+# 写过的表: 本进程版本 +1，建表/删表时表格列表也要重读；配了共享缓存的通知其他副本。返回这张表的新版本
+def mark_written(tab_name, tab_set_changed=False):
+    v = get_local_versions()
+    v[tab_name] += 1
+    if tab_set_changed: v["*"] += 1
+    if SHARED:
+        try: SHARED.publish([tab_name] + (["#tabs"] if tab_set_changed else []), STORE.token())
+        except: pass
+    probe_versions.clear()
+    return v[tab_name]
+
+# 手动刷新: 丢掉所有表的缓存 (共享缓存也一起作废)
+def clear_caches():
+    if SHARED:
+        try: SHARED.publish(["*", "#tabs"])
+        except: pass
+    get_tab_cache().clear()
+    get_dir_cache().clear()
+    get_index_cache().clear()
+    probe_versions.clear()
+
+@st.cache_resource(show_spinner=False)
+def get_save_queue():
+    return SaveQueue(STORE, mark_written, SAVE_RETRIES, SAVE_BACKOFF, SAVE_BACKOFF_MAX, SAVE_STATUS_KEEP) if STORE else None
+
+SAVEQ = get_save_queue()
+
+# 本会话提交过的改动 (侧边栏显示同步状态)
+def track_save(op_id):
+    ids = st.session_state.setdefault("my_saves", [])
+    ids.append(op_id)
+    del ids[:-SAVE_SHOWN]
+    return op_id
+
+# 侧边栏同步状态: 还有改动在排队就每 SAVE_POLL 秒刷新一次，全部写完后整页刷新一次
+def render_save_status():
+    ids = st.session_state.get("my_saves", [])
+    if not ids or not SAVEQ: return
+    busy = any(s["state"] == "pending" for s in SAVEQ.states(ids).values())
+    def panel():
+        states = SAVEQ.states(ids)
+        if busy and not any(s["state"] == "pending" for s in states.values()): st.rerun()
+        for op_id, s in reversed(list(states.items())):
+            if s["state"] == "pending":
+                st.caption(f"⏳ {s['label']} 同步中" + (f" (第 {s['tries']} 次重试: {s['error']})" if s["tries"] else ""))
+            elif s["state"] == "synced": st.caption(f"✅ {s['label']} 已同步")
             else:
-                ws.update([df.columns.values.tolist()] + df.astype(str).values.tolist())
-            
-            # 强制刷新缓存
-            load_data.clear()
-            get_all_sheet_titles.clear() 
-            return True
-    except Exception as e:
-        st.error(f"网络超时，请重试: {e}")
-        return False
+                c1, c2 = st.columns([4, 1])
+                c1.caption(f"❌ {s['label']} 失败: {s['error']}")
+                if s["retry"] and c2.button("重试", key=f"retry_{op_id}"):
+                    SAVEQ.retry(op_id)
+                    st.rerun()
+    st.fragment(panel, run_every=SAVE_POLL if busy else None)()
+
+# 表还不存在 (后端没有、队列里也没有) 时第一次写入要建表
+def is_new_tab(tab_name):
+    return tab_name not in get_all_sheet_titles() and not SAVEQ.pending(tab_name)
+
+# 保存数据: 放进后台写队列马上返回改动编号 (写出时只写和快照的差异)
+def save_data(tab_name, df, label=None, after=()):
+    if not STORE: return None
+    return track_save(SAVEQ.submit(tab_name, "save", label or f"保存「{tab_name}」", after, df=df.copy(), new=is_new_tab(tab_name)))
+
+# 追加行: 一次 append_rows，不重写整表 (表还不存在时直接建表)
+def append_data(tab_name, df, label=None):
+    if not STORE: return None
+    if df.empty: return True
+    return track_save(SAVEQ.submit(tab_name, "append", label or f"追加到「{tab_name}」", rows=df.astype(str).values.tolist(),
+                                   header=[str(c) for c in df.columns], new=is_new_tab(tab_name)))
+
+# 删除表: 直接删，排队中还没写的改动作废
+def delete_tab(tab_name):
+    SAVEQ.discard(tab_name, "表已被删除")
+    STORE.delete_tab(tab_name)
+    mark_written(tab_name, True)
 
 # 辅助函数
-def try_float(x):
-    try: return float(str(x).replace('¥','').replace('$','').replace(',','').strip())
-    except: return 0.0
+# 金额文本 -> 数值 (整列一次处理)，转不了的当 0
+def to_number(s):
+    return pd.to_numeric(s.astype(str).str.replace(r"[¥$,]", "", regex=True).str.strip(), errors="coerce").fillna(0.0)
 
-def get_permissions():
-    df = load_data("Permissions", ["table_name", "allowed_uids"])
-    perms = {}
-    if not df.empty:
-        for _, r in df.iterrows():
-            perms[r["table_name"]] = str(r["allowed_uids"]).split(",")
-    return perms
+# 公式只解析一次: 找出用到了哪些列 (列名可以用 `反引号` 括起来)
+@st.cache_data(show_spinner=False)
+def formula_columns(fma, columns):
+    quoted = re.findall(r"`([^`]*)`", fma)
+    tree = ast.parse(re.sub(r"`[^`]*`", "_", fma), mode="eval")
+    used = {n.id for n in ast.walk(tree) if isinstance(n, ast.Name)} | set(quoted)
+    return [c for c in columns if c in used]
+
+# 数值列缓存: (表名, 列名) -> (表的缓存戳, 转换好的数值列)，表没变就不重新转换
+@st.cache_resource
+def get_typed_cache():
+    return {}
+
+def typed_columns(t_name, df, cols):
+    stamp = data_stamp(t_name)
+    cache = get_typed_cache()
+    out = {}
+    for c in cols:
+        hit = cache.get((t_name, c))
+        if stamp is None or hit is None or hit[0] != stamp or not hit[1].index.equals(df.index):
+            hit = (stamp, to_number(df[c]))
+            if stamp is not None: cache[(t_name, c)] = hit
+        out[c] = hit[1]
+    return pd.DataFrame(out, index=df.index)
+
+def eval_formula(fma, typed):
+    try: res = typed.eval(fma, engine=EVAL_ENGINE)
+    except Exception:
+        if EVAL_ENGINE == "python": raise
+        res = typed.eval(fma, engine="python") # numexpr 不支持的写法退回普通引擎
+    return res.round(2).astype(str)
+
+def saved_formulas(t_name):
+    df = load_data("Formulas", FORMULA_COLS)
+    df = df[df["table_name"] == t_name]
+    return list(zip(df["result_col"], df["formula"]))
+
+def save_formula(t_name, res_col, fma):
+    df = load_data("Formulas", FORMULA_COLS)
+    df = df[~((df["table_name"] == t_name) & (df["result_col"] == res_col))]
+    new_r = {"table_name": t_name, "result_col": res_col, "formula": fma}
+    save_data("Formulas", pd.concat([df, pd.DataFrame([new_r])], ignore_index=True), f"保存公式「{res_col}」")
+
+# 保存表格时按已保存的公式重算，只算用到的列有变化的行和新增的行 (cur 是合并前后端的表)
+def reapply_formulas(t_name, merged, cur):
+    for res_col, fma in saved_formulas(t_name):
+        try:
+            refs = formula_columns(fma, tuple(merged.columns))
+            old = cur.reindex(index=merged.index, columns=refs)
+            dirty = merged[refs].ne(old).any(axis=1) | ~merged.index.isin(cur.index)
+            if not dirty.any(): continue
+            if res_col not in merged.columns: merged[res_col] = ""
+            merged.loc[dirty, res_col] = eval_formula(fma, merged.loc[dirty, refs].apply(to_number))
+        except: continue
+    return merged
+
+# 人员/权限目录: 工号 -> 人、姓名 -> 工号、表名 -> 授权工号集合，查找都是字典操作
+# 按 Users/Permissions 的数据戳 (含排队中的改动) 建一次，所有会话共用，表没变就不重建
+class Directory:
+    def __init__(self, users, perms):
+        self.users = {u["uid"]: u for u in users.to_dict("records")}
+        first = users.drop_duplicates("name") # 重名时和以前一样取第一个
+        self.uid_by_name = dict(zip(first["name"], first["uid"]))
+        self.name_by_uid = dict(zip(users["uid"], users["name"]))
+        self.staff = [u for u, r in self.users.items() if r["role"] != "admin"]
+        self.allowed = {t: frozenset(str(v).split(",")) for t, v in zip(perms["table_name"], perms["allowed_uids"])}
+
+    def can_see(self, uid, table):
+        return uid in self.allowed.get(table, ())
+
+@st.cache_resource
+def get_dir_cache():
+    return {}
+
+def get_directory():
+    titles = get_all_sheet_titles()
+    tabs = [t for t in SYS_TABS if t in titles]
+    try: read_tabs(tabs) # 先把过期的系统表补读进缓存
+    except: pass
+    # 和 load_data 看到的内容一致: 排队中还没写出去的改动 (比如刚加的人) 也算进键里
+    key = tuple((data_stamp(t), SAVEQ.pending(t) if SAVEQ else ()) for t in ("Users", "Permissions"))
+    dc = get_dir_cache()
+    if "dir" not in dc or dc["key"] != key:
+        users = load_data("Users", ["uid", "name", "pwd", "role"])
+        perms = load_data("Permissions", ["table_name", "allowed_uids"])
+        dc.update(key=key, dir=Directory(users, perms))
+    return dc["dir"]
 
 def save_permissions(t_name, uids):
     df = load_data("Permissions", ["table_name", "allowed_uids"])
     df = df[df["table_name"] != t_name]
     new_r = {"table_name": t_name, "allowed_uids": ",".join(uids)}
-    save_data("Permissions", pd.concat([df, pd.DataFrame([new_r])], ignore_index=True))
+    save_data("Permissions", pd.concat([df, pd.DataFrame([new_r])], ignore_index=True), f"保存「{t_name}」权限")
+
+def new_ids(n):
+    return [uuid.uuid4().hex[:12] for _ in range(n)]
+
+# 今日日常任务: 岗位配置按工号对上姓名，固定职责按行拆开，一行一条任务
+def expand_assignments(assign_df, directory, bj_date):
+    a = assign_df.assign(user=assign_df["uid"].map(directory.name_by_uid)).dropna(subset=["user"])
+    a = a.assign(task=a["tasks"].astype(str).str.split("\n")).explode("task")
+    a["task"] = a["task"].str.strip()
+    a = a[a["task"] != ""]
+    return pd.DataFrame({"date": bj_date, "store": a["store"], "user": a["user"], "task": a["task"], "status": "进行中", "time": "-",
+                         "id": new_ids(len(a)), "rev": "0"})
+
+# 去掉当天已经发布过的任务 (按 日期+店铺+负责人+内容 判重)，重复点击不会发两遍
+def unpublished(new_df, tasks_df):
+    key = ["date", "store", "user", "task"]
+    new_df = new_df.drop_duplicates(key)
+    today = tasks_df[tasks_df["date"].isin(new_df["date"].unique())]
+    done = pd.MultiIndex.from_frame(today[key])
+    return new_df[~pd.MultiIndex.from_frame(new_df[key]).isin(done)]
+
+# 老数据没有行号的补上 (差异写入，只写这几格)
+def ensure_task_ids(tasks_df):
+    missing = tasks_df["id"] == ""
+    if not missing.any(): return tasks_df
+    tasks_df = tasks_df.copy()
+    tasks_df.loc[missing, "id"] = new_ids(int(missing.sum()))
+    tasks_df.loc[tasks_df["rev"] == "", "rev"] = "0"
+    save_data("Tasks", tasks_df, "补全任务行号")
+    return tasks_df
+
+# 打卡: 只改这一行的状态和时间，写之前核对行版本号 (进后台写队列，同一时段的打卡合并成一次写)
+# 版本变了但还没完成 (比如任务内容被改过) 就按新版本再试，已经被完成/删除则算冲突，在同步状态里提示
+def check_in(task, bj_time):
+    if not STORE: return None
+    def rebase(cur):
+        if cur.get("status") != "进行中": return None
+        return {"status": "完成", "time": bj_time, "rev": str(int(cur["rev"] or 0) + 1)}, {"status": "进行中", "rev": cur["rev"]}
+    changes, expect = rebase({"status": "进行中", "rev": task["rev"]})
+    return track_save(SAVEQ.submit("Tasks", "update", f"打卡「{task['task']}」", key_col="id", key=task["id"],
+                                   changes=changes, expect=expect, rebase=rebase))
+
+# 任务分区: Tasks 只放未完成和最近完成的 (热表)，更早的按月放在 Tasks_YYYYMM，新的月份在前
+def task_archives(titles):
+    return sorted((t for t in titles if t.startswith("Tasks_") and len(t) == 12 and t[6:].isdigit()), reverse=True)
+
+# 滚动归档: 已完成且早于 TASK_HOT_DAYS 天前的任务按月追加到归档表，再从热表删掉
+# 先写归档再删热表 (热表的保存排在归档写成功之后)，中途失败最多多出一份，不会丢任务；返回归档了几条
+def archive_tasks(tasks_df, today):
+    cutoff = (datetime.strptime(today, "%Y-%m-%d") - timedelta(days=TASK_HOT_DAYS)).strftime("%Y-%m-%d")
+    old = (tasks_df["status"] == "完成") & (tasks_df["date"] < cutoff) & tasks_df["date"].str.match(r"\d{4}-\d{2}-\d{2}$")
+    if not old.any(): return 0
+    moved = tasks_df[old]
+    ids = []
+    for month, part in moved.groupby(moved["date"].str[:7].str.replace("-", "")):
+        op = append_data(f"Tasks_{month}", part, f"归档到「Tasks_{month}」")
+        if not op: return 0
+        ids.append(op)
+    if not save_data("Tasks", tasks_df[~old], "归档后清理任务表", after=ids): return 0
+    return int(old.sum())
+
+def editor_dirty(ed_key):
+    pending = st.session_state.get(ed_key) or {}
+    return any(pending.get(k) for k in ("edited_rows", "added_rows", "deleted_rows"))
+
+# 协作表编辑基线: 编辑器里没有未保存的改动时跟随最新数据；有改动时固定在开始编辑的那一份
+# (数据一变 st.data_editor 就会重置，正在编辑的内容会丢，而且改动里的行号要对应编辑时看到的表)
+# 返回 (基线的缓存戳, 基线)，戳用来找这份数据的索引
+def editor_base(t_name, df, ed_key):
+    if f"base_{t_name}" not in st.session_state or not editor_dirty(ed_key):
+        st.session_state[f"base_{t_name}"] = (data_stamp(t_name), df)
+    return st.session_state[f"base_{t_name}"]
+
+# 协作表的查找索引: 每列一份 值 -> 行位置 (等值筛选) 和一份排好序的小写值 (前缀搜索用二分查找)
+# 用到哪列才建哪列；按表的缓存戳建一次，所有会话共用
+class TableIndex:
+    def __init__(self, df):
+        self.cols = {c: df[c].to_numpy(dtype=str) for c in df.columns}
+        self.n = len(df)
+        self.eq = {}
+        self.sorted = {}
+
+    def equal(self, c, v):
+        if c not in self.eq:
+            codes, uniques = pd.factorize(self.cols[c])
+            order = np.argsort(codes, kind="stable")
+            self.eq[c] = dict(zip(uniques, np.split(order, np.cumsum(np.bincount(codes, minlength=len(uniques)))[:-1])))
+        return self.eq[c].get(v, np.empty(0, dtype=np.intp))
+
+    def prefix(self, c, p):
+        if c not in self.sorted:
+            keys = np.char.lower(self.cols[c])
+            order = np.argsort(keys, kind="stable")
+            self.sorted[c] = (keys[order], order)
+        keys, order = self.sorted[c]
+        p = p.lower()
+        return order[np.searchsorted(keys, p):np.searchsorted(keys, p + "\U0010ffff")]
+
+    # 筛选: q 是任一列以它开头 (不分大小写)，col/val 是某列等于；都不填就是全表，返回升序的行位置
+    def find(self, q="", col=None, val=""):
+        rows = np.arange(self.n)
+        if q: rows = np.unique(np.concatenate([self.prefix(c, q) for c in self.cols] or [rows[:0]]))
+        if col in self.cols and val != "": rows = np.intersect1d(rows, self.equal(col, val))
+        return rows
+
+@st.cache_resource
+def get_index_cache():
+    return {}
+
+def table_index(t_name, stamp, df):
+    cache = get_index_cache()
+    hit = cache.get(t_name)
+    if stamp is None or hit is None or hit[0] != stamp or hit[1].n != len(df):
+        hit = (stamp, TableIndex(df))
+        if stamp is not None: cache[t_name] = hit
+    return hit[1]
+
+# 编辑器只拿到一页，把改动里的页内行号换回基线里的行位置，merge_patch 按基线对齐
+def page_patch(state, ids):
+    return {"edited_rows": {int(ids[int(i)]): cells for i, cells in state.get("edited_rows", {}).items()},
+            "deleted_rows": [int(ids[int(i)]) for i in state.get("deleted_rows", [])],
+            "added_rows": state.get("added_rows", [])}
+
+# 流式读取上传的文件: 逐块产出 (已读比例, 行列表)，第一块的第一行是表头，内存里只有当前这一块
+def iter_upload(up):
+    size = max(up.size, 1)
+    if up.name.endswith(".csv"):
+        first = True
+        for chunk in pd.read_csv(up, dtype=str, keep_default_na=False, chunksize=IMPORT_CHUNK_ROWS):
+            rows = chunk.values.tolist()
+            if first: rows = [[str(c) for c in chunk.columns]] + rows
+            first = False
+            yield min(up.tell() / size, 1.0), rows
+        return
+    import openpyxl
+    wb = openpyxl.load_workbook(up, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        total = max(ws.max_row or 1, 1)
+        rows = []
+        for n, r in enumerate(ws.iter_rows(values_only=True), 1):
+            if all(v is None for v in r): continue
+            rows.append(["" if v is None else str(v) for v in r])
+            if len(rows) >= IMPORT_CHUNK_ROWS:
+                yield min(n / total, 1.0), rows
+                rows = []
+        if rows: yield 1.0, rows
+    finally:
+        wb.close()
+
+# 导入: 先按大小分批写进暂存表，全部写完再整表换入；中途失败只删暂存表，原表不动
+def import_table(t_name, up, bar):
+    staging = t_name + IMPORT_SUFFIX
+    SAVEQ.drain(t_name) # 排队的改动先写完，免得写在导入之后把导入的内容盖掉
+    if staging in get_all_sheet_titles(): STORE.delete_tab(staging) # 上次失败留下的
+    header, batch, size, n = None, [], 0, 0
+    try:
+        for frac, rows in iter_upload(up):
+            if header is None:
+                header, rows = rows[0], rows[1:]
+                STORE.create_tab(staging, header)
+            for r in rows:
+                batch.append(r)
+                size += len(json.dumps(r, ensure_ascii=False).encode("utf-8"))
+                if size >= IMPORT_BATCH_BYTES:
+                    STORE.append_rows(staging, batch)
+                    n += len(batch)
+                    batch, size = [], 0
+            bar.progress(frac, text=f"已写入 {n + len(batch)} 行...")
+        if header is None: raise ValueError("文件是空的")
+        if batch: STORE.append_rows(staging, batch)
+        STORE.swap_tab(staging, t_name)
+        return n + len(batch)
+    except:
+        try: STORE.delete_tab(staging)
+        except: pass
+        raise
+    finally:
+        mark_written(t_name, True)
+        mark_written(staging, True)
 
 # ================= 3. 页面主逻辑 =================
 st.set_page_config(page_title="合泰包装盒有限公司", layout="wide")
@@ -119,12 +541,10 @@ if 'user_info' not in st.session_state: st.session_state.user_info = {}
 # Token 自动登录
 token = st.query_params.get("token", None)
 if not st.session_state.logged_in and token:
-    u_df = load_data("Users", ["uid", "name", "pwd", "role"])
-    if not u_df.empty:
-        me = u_df[u_df["uid"] == token]
-        if not me.empty:
-            st.session_state.logged_in = True
-            st.session_state.user_info = me.iloc[0].to_dict()
+    me = get_directory().users.get(token)
+    if me:
+        st.session_state.logged_in = True
+        st.session_state.user_info = dict(me)
 
 # 登录界面
 if not st.session_state.logged_in:
@@ -133,7 +553,7 @@ if not st.session_state.logged_in:
     if u_df.empty:
         # 初始化 Boss
         u_df = pd.DataFrame([{"uid": "u_boss", "name": "Boss", "pwd": "666", "role": "admin"}])
-        save_data("Users", u_df)
+        save_data("Users", u_df, "初始化管理员账号")
     
     names = u_df["name"].tolist()
     c1, c2 = st.columns([2,1])
@@ -142,10 +562,13 @@ if not st.session_state.logged_in:
         pwd = st.text_input("密码", type="password")
         remember = st.checkbox("记住我 (免下次登录)")
         if st.button("登录系统", type="primary"):
-            me = u_df[u_df["name"] == s_name].iloc[0]
-            if str(me["pwd"]) == pwd:
+            directory = get_directory()
+            me = directory.users.get(directory.uid_by_name.get(s_name))
+            if me is None:
+                st.error("找不到这个账号，可能刚改过还没同步，请刷新后再试")
+            elif str(me["pwd"]) == pwd:
                 st.session_state.logged_in = True
-                st.session_state.user_info = me.to_dict()
+                st.session_state.user_info = dict(me)
                 if remember: st.query_params["token"] = me["uid"]
                 st.rerun()
             else:
@@ -161,8 +584,7 @@ else:
         st.caption(f"🕒 北京时间: {bj_time}")
         
         if st.button("刷新最新数据", type="primary"):
-            load_data.clear()
-            get_all_sheet_titles.clear()
+            clear_caches()
             st.rerun()
         
         st.divider()
@@ -170,14 +592,16 @@ else:
         
         # 获取可见表格
         all_tabs = get_all_sheet_titles()
-        sys_tabs = ["Users", "Tasks", "Assignments", "Permissions", "Settings"]
+        if SAVEQ: all_tabs = all_tabs + SAVEQ.new_tabs(all_tabs) # 刚建、还在排队写出的表
+        sys_tabs = ["Users", "Tasks", "Assignments", "Permissions", "Formulas", "Settings"]
+        sys_tabs += task_archives(all_tabs) + [t for t in all_tabs if t.endswith(IMPORT_SUFFIX)]
         custom_tabs = [t for t in all_tabs if t not in sys_tabs]
         
-        perms = get_permissions()
+        directory = get_directory()
         vis_tabs = []
         for t in custom_tabs:
             # 如果是管理员，或者是被授权的员工
-            if is_admin or (user["uid"] in perms.get(t, [])):
+            if is_admin or directory.can_see(user["uid"], t):
                 vis_tabs.append(t)
         
         if vis_tabs:
@@ -185,6 +609,7 @@ else:
             for t in vis_tabs: pages.append(f"📊 {t}")
             
         nav = st.radio("系统导航", pages)
+        render_save_status()
         st.divider()
         if st.button("退出登录"):
             st.session_state.logged_in = False
@@ -194,7 +619,11 @@ else:
     # ================= 模块 1：任务管理 =================
     if nav == "📦 任务管理":
         st.subheader("📋 任务管理中心")
-        tasks_df = load_data("Tasks", ["date", "store", "user", "task", "status", "time"])
+        tasks_df = ensure_task_ids(load_data("Tasks", TASK_COLS))
+        archived = archive_tasks(tasks_df, bj_date) if is_admin else 0
+        if archived:
+            st.toast(f"🗄️ 已把 {archived} 条早于 {TASK_HOT_DAYS} 天的已完成任务移入月度归档")
+            tasks_df = load_data("Tasks", TASK_COLS)
         assign_df = load_data("Assignments", ["store", "uid", "tasks"])
         users_df = load_data("Users", ["uid", "name", "pwd", "role"])
         all_names = users_df["name"].tolist()
@@ -208,21 +637,16 @@ else:
                 c_gen, c_clear = st.columns([1, 1])
                 with c_gen:
                     if st.button("⚡ 一键发布今日日常任务"):
-                        new_rows = []
-                        for _, r in assign_df.iterrows():
-                            runner = users_df[users_df["uid"]==r["uid"]]
-                            if not runner.empty:
-                                runner_name = runner.iloc[0]["name"]
-                                lines = [x.strip() for x in str(r["tasks"]).split('\n') if x.strip()]
-                                for l in lines:
-                                    new_rows.append({"date": bj_date, "store": r["store"], "user": runner_name, "task": l, "status": "进行中", "time": "-"})
-                        if new_rows:
-                            save_data("Tasks", pd.concat([tasks_df, pd.DataFrame(new_rows)], ignore_index=True))
+                        new_df = unpublished(expand_assignments(assign_df, directory, bj_date), tasks_df)
+                        if new_df.empty:
+                            st.info("今日任务都已发布过")
+                        elif append_data("Tasks", new_df.reindex(columns=tasks_df.columns, fill_value=""), "发布今日日常任务"):
                             st.success("发布成功")
                             st.rerun()
                 with c_clear:
                     if st.button("🗑️ 清空所有任务历史"):
-                        save_data("Tasks", pd.DataFrame(columns=tasks_df.columns))
+                        save_data("Tasks", pd.DataFrame(columns=tasks_df.columns), "清空任务历史")
+                        for t in task_archives(get_all_sheet_titles()): delete_tab(t)
                         st.rerun()
 
                 st.divider()
@@ -234,33 +658,33 @@ else:
                     t_content = c_tmp3.text_input("任务内容")
                     if st.button("➕ 发布临时任务"):
                         if t_content:
-                            new_r = {"date": bj_date, "store": t_store, "user": t_who, "task": t_content, "status": "进行中", "time": "-"}
-                            save_data("Tasks", pd.concat([tasks_df, pd.DataFrame([new_r])], ignore_index=True))
-                            st.success("已发布")
-                            st.rerun()
+                            new_r = {"date": bj_date, "store": t_store, "user": t_who, "task": t_content, "status": "进行中", "time": "-", "id": new_ids(1)[0], "rev": "0"}
+                            if append_data("Tasks", pd.DataFrame([new_r]).reindex(columns=tasks_df.columns, fill_value=""), f"发布临时任务「{t_content}」"):
+                                st.success("已发布")
+                                st.rerun()
 
                 st.divider()
                 st.markdown("##### 3️⃣ 固定岗位配置")
                 # 转换显示
-                uid_to_name = dict(zip(users_df["uid"], users_df["name"]))
-                name_to_uid = dict(zip(users_df["name"], users_df["uid"]))
-                
                 view_assign = assign_df.copy()
-                view_assign["uid"] = view_assign["uid"].map(uid_to_name)
+                view_assign["uid"] = view_assign["uid"].map(directory.name_by_uid)
                 view_assign = view_assign.rename(columns=CN_MAP)
                 
                 edited_assign = st.data_editor(view_assign, num_rows="dynamic", use_container_width=True)
                 
                 if st.button("💾 保存岗位配置"):
                     save_assign = edited_assign.rename(columns=EN_MAP)
-                    save_assign["uid"] = save_assign["uid"].map(name_to_uid)
+                    save_assign["uid"] = save_assign["uid"].map(directory.uid_by_name)
                     save_assign = save_assign.dropna(subset=["uid"])
-                    save_data("Assignments", save_assign)
+                    save_data("Assignments", save_assign, "保存岗位配置")
                     st.success("配置已保存")
 
             with t2:
-                # 任务总表
-                view_tasks = tasks_df.rename(columns=CN_MAP)
+                # 任务总表: 默认看热表，选了月份才读那个月的归档
+                part = st.selectbox("范围", ["未完成 + 近期"] + task_archives(get_all_sheet_titles()),
+                                    format_func=lambda t: t if not t.startswith("Tasks_") else f"{t[6:10]}年{t[10:]}月 归档")
+                shown = tasks_df if part == "未完成 + 近期" else load_data(part, TASK_COLS)
+                view_tasks = shown.drop(columns=["id", "rev"], errors="ignore").rename(columns=CN_MAP)
                 st.dataframe(view_tasks, use_container_width=True)
 
             with t3:
@@ -274,7 +698,7 @@ else:
                     save_users = edited_users.rename(columns=EN_MAP)
                     for i in range(len(save_users)):
                         if not save_users.iloc[i]["uid"]: save_users.at[i, "uid"] = f"u_{str(uuid.uuid4())[:6]}"
-                    save_data("Users", save_users)
+                    save_data("Users", save_users, "保存人员名单")
                     st.success("人员表已更新")
                     st.rerun()
         else:
@@ -293,17 +717,14 @@ else:
                         c1, c2, c3 = st.columns([2, 5, 2])
                         c1.markdown(f"**🏬 {row['store']}**")
                         c2.write(row['task'])
-                        if c3.button("✅ 完成打卡", key=f"k_{idx}"):
-                            tasks_df.at[idx, "status"] = "完成"
-                            tasks_df.at[idx, "time"] = bj_time
-                            save_data("Tasks", tasks_df)
-                            st.rerun()
+                        if c3.button("✅ 完成打卡", key=f"k_{row['id']}"):
+                            if check_in(row, bj_time): st.rerun()
             else:
                 st.info("👍 你真棒！所有待办任务都完成了。")
 
             if not completed.empty:
                 st.markdown("#### ✅ 已完成")
-                st.dataframe(completed.rename(columns=CN_MAP), use_container_width=True)
+                st.dataframe(completed.drop(columns=["id", "rev"]).rename(columns=CN_MAP), use_container_width=True)
 
     # ================= 模块 2：自定义表格 (协作核心) =================
     elif nav.startswith("📊"):
@@ -317,59 +738,83 @@ else:
                 t_perm, t_calc, t_imp = st.tabs(["🔒 权限", "🧮 计算器", "📤 导入Excel"])
                 
                 with t_perm:
-                    all_u = load_data("Users", ["uid", "name"])
-                    staffs = all_u[all_u["role"]!="admin"]
-                    curr = get_permissions().get(t_name, [])
-                    sel = st.multiselect("勾选允许查看/编辑的员工", staffs["uid"].tolist(), default=[u for u in curr if u in staffs["uid"].tolist()], format_func=lambda x: staffs[staffs["uid"]==x]["name"].values[0])
+                    curr = directory.allowed.get(t_name, frozenset())
+                    sel = st.multiselect("勾选允许查看/编辑的员工", directory.staff, default=[u for u in directory.staff if u in curr], format_func=directory.name_by_uid.get)
                     if st.button("保存权限设置"):
                         save_permissions(t_name, sel)
                         st.success("已保存")
                 
                 with t_calc:
                     st.caption("公式示例: `(售价 - 成本) * 汇率`")
+                    for r_col, f in saved_formulas(t_name): st.caption(f"已保存: {r_col} = {f} (保存表格时自动重算改动的行)")
                     c1, c2 = st.columns([3, 1])
                     fma = c1.text_input("计算公式")
                     res_col = c1.text_input("结果存入列名", value="计算结果")
                     if c2.button("执行计算"):
                         if fma:
                             try:
-                                tmp = df.copy()
-                                for c in df.columns: tmp[c] = tmp[c].apply(try_float)
-                                df[res_col] = tmp.eval(fma).round(2).astype(str)
+                                refs = formula_columns(fma, tuple(df.columns))
+                                df[res_col] = eval_formula(fma, typed_columns(t_name, df, refs))
                                 save_data(t_name, df)
+                                save_formula(t_name, res_col, fma)
                                 st.success("计算完成")
                                 st.rerun()
                             except Exception as e:
                                 st.error(f"公式错误: {e}")
 
                 with t_imp:
-                    st.warning("⚠️ 警告：导入将覆盖当前表格所有内容")
+                    st.warning("⚠️ 警告：导入将覆盖当前表格所有内容 (导入完成前原表不受影响)")
                     up = st.file_uploader("上传 Excel/CSV", type=['xlsx', 'csv'])
                     if up and st.button("确认覆盖导入"):
                         try:
-                            if up.name.endswith('.csv'): idf = pd.read_csv(up)
-                            else: idf = pd.read_excel(up)
-                            save_data(t_name, idf.astype(str))
-                            st.success("导入成功")
+                            n = import_table(t_name, up, st.progress(0.0, text="正在导入..."))
+                            st.session_state.pop(f"base_{t_name}", None)
+                            st.success(f"导入成功，共 {n} 行")
                             st.rerun()
                         except Exception as e:
                             st.error(f"失败: {e}")
         
         # --- 协作编辑区 (所有人可见) ---
         if not df.empty and len(df.columns)>0:
-            # 所有人都能看见编辑器
-            edited = st.data_editor(df, num_rows="dynamic", use_container_width=True, key=f"ed_{t_name}")
+            # 所有人都能看见编辑器 (保存成功后换一个 key，编辑器从最新数据重新开始)
+            ed_key = f"ed_{t_name}_{st.session_state.get(f'ed_n_{t_name}', 0)}"
+            stamp, base = editor_base(t_name, df, ed_key)
+            # 筛选和分页在服务端做，编辑器只拿当前这一页；有没保存的改动时先不让翻页/换筛选
+            dirty = editor_dirty(ed_key)
+            f_q, f_col, f_val = st.columns([2, 1, 1])
+            q = f_q.text_input("🔍 搜索 (任一列以此开头)", key=f"q_{t_name}", disabled=dirty)
+            col = f_col.selectbox("筛选列", ["(不筛选)"] + list(base.columns), key=f"fc_{t_name}", disabled=dirty)
+            val = f_val.text_input("等于", key=f"fv_{t_name}", disabled=dirty or col == "(不筛选)")
+            rows = table_index(t_name, stamp, base).find(q.strip(), col, val)
+            n_pages = max(1, -(-len(rows) // PAGE_ROWS))
+            if st.session_state.get(f"pg_{t_name}", 1) > n_pages: st.session_state[f"pg_{t_name}"] = n_pages
+            page = st.number_input("页码", min_value=1, max_value=n_pages, key=f"pg_{t_name}", disabled=dirty or n_pages == 1)
+            ids = rows[(page - 1) * PAGE_ROWS:page * PAGE_ROWS]
+            st.caption(f"共 {len(rows)} 行 (全表 {len(base)} 行)，第 {page}/{n_pages} 页" + ("；有未保存的修改，保存后才能翻页或筛选" if dirty else ""))
+            st.data_editor(base.iloc[ids], num_rows="dynamic", use_container_width=True, key=ed_key)
+            
+            saved = st.session_state.pop(f"saved_{t_name}", None)
+            if saved is not None:
+                st.success("✅ 已保存！后台同步完成后 (见侧边栏)，同事们刷新就能看到你的修改。")
+                if saved: st.warning("以下改动和同事的修改冲突，已保留同事的版本：\n\n" + "\n\n".join(saved))
             
             c_sv, c_del = st.columns([4,1])
-            # 所有人都能保存
+            # 所有人都能保存: 只提交自己改过的格子，和保存时的最新数据合并
             if c_sv.button("💾 保存修改", type="primary"):
-                if save_data(t_name, edited):
-                    st.success("✅ 保存成功！同事们刷新后也能看到你的修改。")
+                probe_versions.clear() # 保存前确认一次别人有没有写过，探测不到就直接重读
+                if not probe_versions(): get_tab_cache().pop(t_name, None)
+                cur = load_data(t_name)
+                merged, conflicts = merge_patch(base, cur, page_patch(st.session_state.get(ed_key) or {}, ids))
+                merged = reapply_formulas(t_name, merged, cur)
+                if save_data(t_name, merged):
+                    st.session_state[f"ed_n_{t_name}"] = st.session_state.get(f"ed_n_{t_name}", 0) + 1
+                    st.session_state.pop(f"base_{t_name}", None)
+                    st.session_state[f"saved_{t_name}"] = conflicts
+                    st.rerun()
             
             # 只有老板能删除表
             if is_admin and c_del.button("🗑️ 删除此表"):
-                get_db_connection().del_worksheet(get_db_connection().worksheet(t_name))
-                get_all_sheet_titles.clear()
+                delete_tab(t_name)
                 st.rerun()
         else:
             st.info("📭 这是一个空表，请老板导入数据。")
@@ -382,6 +827,13 @@ else:
                 nn = st.text_input("表名")
                 if st.button("创建"):
                     if nn and nn not in all_tabs:
-                        save_data(nn, pd.DataFrame(columns=["A"]))
+                        save_data(nn, pd.DataFrame(columns=["A"]), f"新建表格「{nn}」")
                         st.rerun()
 
+    # 性能面板 (仅老板，可选)
+    if is_admin and st.sidebar.toggle("⏱ 性能"):
+        st.divider()
+        st.subheader("⏱ 性能")
+        render_perf_panel()
+
+PERF.flush()
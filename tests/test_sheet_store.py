@@ -0,0 +1,307 @@
+# sheet_store 里不依赖页面的部分: 差异写入、改动叠加、后台写队列的合并、协作表三方合并
+# 谷歌表格用 bench/stand_ins.py 里的内存替身，不联网
+import os
+import sys
+import threading
+import time
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "bench")]
+
+from sheet_store import SheetsStore, SaveQueue, apply_op, merge_patch, write_diff, _kept_rows
+from stand_ins import FakeSpreadsheet
+
+HEADER = ["k", "v"]
+
+def sheet(n=6):
+    return FakeSpreadsheet({"T": [HEADER] + [[f"r{i}", str(i)] for i in range(n)]})
+
+# 记下 batch_update 的请求 (表格级的删行、工作表级的改格子)
+def spy(sh):
+    seen = {"delete": [], "cells": []}
+    ws = sh.tabs["T"]
+    sheet_bu, ws_bu = sh.batch_update, ws.batch_update
+    sh.batch_update = lambda body: (seen["delete"].extend(r["deleteDimension"]["range"] for r in body["requests"]), sheet_bu(body))[1]
+    ws.batch_update = lambda data, **kw: (seen["cells"].extend(data), ws_bu(data, **kw))[1]
+    return seen
+
+def frame(rows, index):
+    return pd.DataFrame(rows, columns=HEADER, index=index)
+
+# ---------- 差异写入 ----------
+
+def test_kept_rows_stops_at_first_unusable_label():
+    assert _kept_rows([0, 2, 3], 5) == [0, 2, 3]
+    assert _kept_rows([0, 2, 1, 3], 5) == [0, 2] # 不递增
+    assert _kept_rows([0, 7, 1], 5) == [0] # 超出旧表
+    assert _kept_rows([0, "x", 1], 5) == [0]
+
+def test_write_diff_deletes_ranges_and_appends():
+    sh = sheet()
+    seen = spy(sh)
+    ws = sh.tabs["T"]
+    old = ws.get_all_values()
+    # 删掉 r1 r2 和 r5，r3 改一格，末尾加一行
+    df = frame([["r0", "0"], ["r3", "33"], ["r4", "4"], ["new", "9"]], [0, 3, 4, 99])
+    new = write_diff(ws, old, df)
+    assert ws.rows == new == [HEADER, ["r0", "0"], ["r3", "33"], ["r4", "4"], ["new", "9"]]
+    # 从后往前删: 先删 r5 (第 7 行)，再删 r1-r2 (第 3-4 行)
+    assert [(r["startIndex"], r["endIndex"]) for r in seen["delete"]] == [(6, 7), (2, 4)]
+    assert seen["cells"] == [{"range": "B3:B3", "values": [["33"]]}]
+    assert sh.calls["append_rows"] == 1 and sh.calls["clear"] == 0
+
+def test_write_diff_without_labels_rewrites_shifted_rows():
+    sh = sheet(4)
+    seen = spy(sh)
+    ws = sh.tabs["T"]
+    write_diff(ws, ws.get_all_values(), frame([["r0", "0"], ["r2", "2"], ["r3", "3"]], range(3)))
+    assert ws.rows == [HEADER, ["r0", "0"], ["r2", "2"], ["r3", "3"]]
+    assert seen["delete"] == [{"sheetId": ws.id, "dimension": "ROWS", "startIndex": 4, "endIndex": 5}]
+    assert len(seen["cells"]) == 2 # 没有行标签就只能按位置比，错开的两行整行重写
+
+def test_write_diff_skips_blank_rows():
+    sh = sheet(2)
+    ws = sh.tabs["T"]
+    df = frame([["r0", "0"], ["", ""], ["r1", "1"], ["new", "9"], ["", ""]], [0, 7, 8, 9, 10])
+    new = write_diff(ws, ws.get_all_values(), df)
+    # 中间的空行不写 (r1 没有行标签对应，按删掉再追加处理)
+    assert ws.rows == new == [HEADER, ["r0", "0"], ["r1", "1"], ["new", "9"]]
+
+def test_write_diff_append_landing_elsewhere_drops_the_result():
+    sh = sheet(1)
+    ws = sh.tabs["T"]
+    old = ws.get_all_values()
+    ws.append_rows([["other", "9"]]) # 快照之后别的副本追加了一行
+    assert write_diff(ws, old, frame([["r0", "0"], ["c", "3"]], range(2))) is None
+    assert ws.rows == [HEADER, ["r0", "0"], ["other", "9"], ["c", "3"]]
+
+def test_append_rows_keeps_snapshot_only_when_rows_land_after_it():
+    sh = sheet(1)
+    store = SheetsStore(sh)
+    store.load_tab("T")
+    store.append_rows("T", [["a", "1"]])
+    assert store.snaps["T"] == sh.tabs["T"].rows == [HEADER, ["r0", "0"], ["a", "1"]]
+    sh.tabs["T"].append_rows([["other", "9"]]) # 别的副本追加的
+    store.append_rows("T", [["b", "2"]])
+    assert "T" not in store.snaps
+    store.save_tab("T", frame([["r0", "0"], ["a", "1"], ["other", "9"], ["b", "20"]], range(4))) # 重读后按真实行号写
+    assert sh.tabs["T"].rows == [HEADER, ["r0", "0"], ["a", "1"], ["other", "9"], ["b", "20"]]
+    assert store.snaps["T"] == sh.tabs["T"].rows
+
+# ---------- 单行条件更新 ----------
+
+TASKS = [["id", "task", "status", "rev"], ["t1", "扫地", "进行中", "0"], ["t2", "开门", "进行中", "1"]]
+
+def tasks_store(loaded=True):
+    sh = FakeSpreadsheet({"T": TASKS})
+    store = SheetsStore(sh)
+    if loaded: store.load_tab("T")
+    return sh, store
+
+def done(rev):
+    return {"status": "完成", "rev": str(int(rev) + 1)}
+
+def test_update_rows_matching_expect():
+    for loaded in (True, False): # 没有快照时表头单独读第一行
+        sh, store = tasks_store(loaded)
+        assert store.update_rows("T", "id", [("t1", done(0), {"rev": "0"})]) == [(True, {"id": "t1", "rev": "1", "status": "完成"})]
+        assert sh.tabs["T"].rows[1] == ["t1", "扫地", "完成", "1"]
+        assert store.snaps.get("T", sh.tabs["T"].rows) == sh.tabs["T"].rows
+
+def test_update_rows_rev_mismatch_and_missing_key():
+    sh, store = tasks_store()
+    res = store.update_rows("T", "id", [("t2", done(0), {"rev": "0"}), ("zz", done(0), {"rev": "0"}), ("t1", done(0), {"rev": "0"})])
+    assert res == [(False, {"id": "t2", "rev": "1"}), (False, None), (True, {"id": "t1", "rev": "1", "status": "完成"})]
+    assert sh.tabs["T"].rows[2] == ["t2", "开门", "进行中", "1"] # 没有核对通过的行不动
+
+def test_update_rows_same_row_twice_checks_the_new_value():
+    sh, store = tasks_store()
+    res = store.update_rows("T", "id", [("t1", done(0), {"rev": "0"}), ("t1", done(0), {"rev": "0"})])
+    assert [ok for ok, _ in res] == [True, False]
+    assert sh.tabs["T"].rows[1] == ["t1", "扫地", "完成", "1"]
+
+# ---------- 改动叠加 ----------
+
+def update(key, changes, expect, rebase=None):
+    return {"kind": "update", "key_col": "k", "key": key, "changes": changes, "expect": expect, "rebase": rebase}
+
+def test_apply_op_append_and_save():
+    raw, ok = apply_op([], {"kind": "append", "header": HEADER, "rows": [["a", "1"]]})
+    assert ok and raw == [HEADER, ["a", "1"]]
+    raw, ok = apply_op(raw, {"kind": "save", "df": frame([["b", 2]], [0])})
+    assert ok and raw == [HEADER, ["b", "2"]]
+
+def test_apply_op_conditional_update():
+    raw = [HEADER, ["a", "1"], ["b", "2"]]
+    new, ok = apply_op(raw, update("b", {"v": 20}, {"v": "2"}))
+    assert ok and new == [HEADER, ["a", "1"], ["b", "20"]] and raw[2] == ["b", "2"] # 不改原数组
+    assert apply_op(raw, update("b", {"v": "20"}, {"v": "9"})) == (raw, False)
+    assert apply_op(raw, update("zz", {"v": "0"}, {})) == (raw, False)
+    assert apply_op([], update("a", {"v": "0"}, {})) == ([], False)
+
+def test_apply_op_rebase():
+    raw = [HEADER, ["a", "5"]]
+    bump = lambda cur: ({"v": str(int(cur["v"]) + 1)}, {"v": cur["v"]}) # 按当前值再加一次
+    assert apply_op(raw, update("a", {"v": "2"}, {"v": "1"}, bump)) == ([HEADER, ["a", "6"]], True)
+    assert apply_op(raw, update("a", {"v": "2"}, {"v": "1"}, lambda cur: None)) == (raw, False)
+
+# ---------- 后台写队列 ----------
+
+def queue(store, landed=None):
+    versions = landed if landed is not None else {}
+    def on_written(tab, tab_set_changed):
+        versions[tab] = versions.get(tab, 0) + 1
+        return versions[tab]
+    return SaveQueue(store, on_written, retries=1, backoff=0.01, backoff_max=0.01)
+
+def settle(q, tab):
+    deadline = time.time() + 5
+    while q.pending(tab) and time.time() < deadline: time.sleep(0.01)
+
+def test_save_run_keeps_labels_and_appends_later_rows():
+    sh = sheet()
+    store = SheetsStore(sh)
+    store.load_tab("T")
+    seen = spy(sh)
+    q = queue(store)
+    df = frame([["r0", "0"], ["r2", "2"], ["r3", "3"], ["r4", "4"], ["r5", "5"]], [0, 2, 3, 4, 5])
+    run = [{"kind": "save", "df": frame([["x", "x"]], [0])}, # 被后面的整表保存盖掉
+           {"kind": "save", "df": df},
+           update("r4", {"v": "40"}, {"v": "4"}),
+           {"kind": "append", "header": HEADER, "rows": [["r6", "6"]]},
+           update("r6", {"v": "60"}, {"v": "6"}),
+           update("zz", {"v": "0"}, {})]
+    assert [ok for _, ok in q._write("T", run)] == [True, True, True, True, True, False]
+    assert sh.tabs["T"].rows == [HEADER, ["r0", "0"], ["r2", "2"], ["r3", "3"], ["r4", "40"], ["r5", "5"], ["r6", "60"]]
+    assert len(seen["delete"]) == 1 # 只删 r1，后面的行不因错位重写
+    assert seen["cells"] == [{"range": "B5:B5", "values": [["40"]]}]
+    assert sh.calls["append_rows"] == 1
+
+def test_queued_appends_coalesce_while_a_write_is_in_flight():
+    sh = sheet(1)
+    store = SheetsStore(sh)
+    store.load_tab("T")
+    gate, entered = threading.Event(), threading.Event()
+    ws = sh.tabs["T"]
+    append = ws.append_rows
+    def slow_append(values, **kw):
+        entered.set()
+        gate.wait(5)
+        return append(values, **kw)
+    ws.append_rows = slow_append
+    landed = {}
+    q = queue(store, landed)
+    add = lambda k: q.submit("T", "append", k, header=HEADER, rows=[[k, "1"]])
+    first = add("a")
+    assert entered.wait(5)
+    rest = [add("b"), add("c"), add("d")]
+    assert q.overlay("T", store.snaps["T"], None)[-4:] == [["a", "1"], ["b", "1"], ["c", "1"], ["d", "1"]]
+    gate.set()
+    q.drain("T", timeout=5)
+    assert sh.calls["append_rows"] == 2 # 第一条单独写，排在它后面的三条并成一次
+    assert [r[0] for r in ws.rows[2:]] == ["a", "b", "c", "d"]
+    assert {s["state"] for s in q.states([first] + rest).values()} == {"synced"}
+    assert landed == {"T": 2}
+
+def test_failed_dependency_and_retries():
+    sh = sheet(1)
+    store = SheetsStore(sh)
+    store.load_tab("T")
+    ws = sh.tabs["T"]
+    def broken(values, **kw): raise RuntimeError("boom")
+    ws.append_rows = broken
+    q = queue(store)
+    a = q.submit("T", "append", "a", header=HEADER, rows=[["a", "1"]])
+    b = q.submit("T", "save", "b", after=[a], df=frame([["b", "2"]], [0]))
+    settle(q, "T")
+    states = q.states([a, b])
+    assert states[a]["state"] == "failed" and states[a]["error"] == "boom"
+    assert states[b]["state"] == "failed" and "前一步" in states[b]["error"]
+    assert ws.rows == [HEADER, ["r0", "0"]]
+
+# 写格子失败的开关: 打开时每次写入先等 gate，再抛错
+def breakable(sh, gate=None):
+    ws = sh.tabs["T"]
+    ok_update = ws.batch_update
+    state = {"broken": True}
+    def batch_update(data, **kw):
+        if gate: gate.wait(5)
+        if state["broken"]: raise RuntimeError("boom")
+        return ok_update(data, **kw)
+    ws.batch_update = batch_update
+    return state
+
+def test_failed_save_cannot_be_retried_after_a_later_write_landed():
+    sh = sheet(3)
+    store = SheetsStore(sh)
+    store.load_tab("T")
+    broken = breakable(sh)
+    q = queue(store)
+    s1 = q.submit("T", "save", "s1", df=frame([["r0", "0"], ["r1", "20"], ["r2", "2"]], range(3)))
+    settle(q, "T")
+    assert q.states([s1])[s1]["retry"]
+    broken["broken"] = False
+    s2 = q.submit("T", "save", "s2", df=frame([["r1", "1"], ["r2", "30"]], [1, 2]))
+    settle(q, "T")
+    assert q.states([s2])[s2]["state"] == "synced"
+    q.retry(s1) # 重试会把 r0 和 r2 的旧值整表写回去
+    settle(q, "T")
+    assert not q.states([s1])[s1]["retry"] and q.states([s1])[s1]["state"] == "failed"
+    assert sh.tabs["T"].rows == [HEADER, ["r1", "1"], ["r2", "30"]]
+
+def test_save_queued_behind_a_failing_save_fails_with_it():
+    sh = sheet(3)
+    store = SheetsStore(sh)
+    store.load_tab("T")
+    gate = threading.Event()
+    broken = breakable(sh, gate)
+    q = queue(store)
+    s1 = q.submit("T", "save", "s1", df=frame([["r0", "0"], ["r1", "20"], ["r2", "2"]], range(3)))
+    deadline = time.time() + 5
+    while not any(op["busy"] for op in q.ops) and time.time() < deadline: time.sleep(0.01)
+    # s2 是在叠加了 s1 的内容上改的 (r1 已经是 20)
+    s2 = q.submit("T", "save", "s2", df=frame([["r0", "0"], ["r1", "20"], ["r2", "30"]], range(3)))
+    gate.set()
+    settle(q, "T")
+    states = q.states([s1, s2])
+    assert [states[i]["state"] for i in (s1, s2)] == ["failed", "failed"]
+    assert sh.tabs["T"].rows == [HEADER, ["r0", "0"], ["r1", "1"], ["r2", "2"]]
+    broken["broken"] = False
+    q.retry(s1) # 连同 s2 一起重新排队
+    settle(q, "T")
+    assert {s["state"] for s in q.states([s1, s2]).values()} == {"synced"}
+    assert sh.tabs["T"].rows == [HEADER, ["r0", "0"], ["r1", "20"], ["r2", "30"]]
+
+# ---------- 协作表三方合并 ----------
+
+def test_merge_patch_unchanged_table():
+    base = frame([["a", "1"], ["b", "2"], ["c", "3"]], range(3))
+    out, conflicts = merge_patch(base, base.copy(), {"edited_rows": {0: {"v": "9"}}, "deleted_rows": [2], "added_rows": [{"k": "d", "v": None}]})
+    assert conflicts == []
+    assert out.values.tolist() == [["a", "9"], ["b", "2"], ["d", ""]]
+    assert out.index.tolist() == [0, 1, 3]
+
+def test_merge_patch_aligns_rows_around_insertions_and_deletions():
+    base = frame([["a", "1"], ["b", "2"], ["c", "3"], ["d", "4"]], range(4))
+    cur = frame([["z", "0"], ["a", "1"], ["b", "2"], ["c", "33"]], range(4)) # 别人在最前面插了一行、改了 c、删了 d
+    state = {"edited_rows": {1: {"v": "20"}, 2: {"v": "30"}, 3: {"k": "dd"}}, "deleted_rows": [0]}
+    out, conflicts = merge_patch(base, cur, state)
+    assert out.values.tolist() == [["z", "0"], ["b", "20"], ["c", "33"]]
+    assert out.index.tolist() == [0, 2, 3] # 保留 cur 的行号，差异写入只删 a 那一行
+    assert conflicts == ["第 3 行「v」已被别人改成 33", "第 4 行已被别人修改或删除"]
+
+def test_merge_patch_row_mostly_changed_by_someone_else():
+    base = pd.DataFrame([["a", "1", "x"], ["b", "2", "y"]], columns=["k", "v", "w"])
+    cur = pd.DataFrame([["a", "1", "x"], ["bb", "22", "y"]], columns=["k", "v", "w"]) # 别人改了 3 格里的 2 格
+    out, conflicts = merge_patch(base, cur, {"edited_rows": {1: {"w": "yy"}}})
+    assert conflicts == [] and out.values.tolist()[1] == ["bb", "22", "yy"]
+    out, conflicts = merge_patch(base, cur, {"edited_rows": {1: {"v": "20"}}})
+    assert conflicts == ["第 2 行「v」已被别人改成 22"] and out.values.tolist()[1] == ["bb", "22", "y"]
+
+def test_merge_patch_keeps_rows_others_modified_before_delete():
+    base = frame([["a", "1"], ["b", "2"]], range(2))
+    cur = frame([["a", "1"], ["b", "3"]], range(2))
+    out, conflicts = merge_patch(base, cur, {"deleted_rows": [1]})
+    assert out.values.tolist() == [["a", "1"], ["b", "3"]]
+    assert conflicts == ["第 2 行删除前已被别人修改，未删除"]
@@ -0,0 +1,48 @@
+# A 股交易日历: 周一到周五，去掉 trade_holidays.txt 里的休市日
+# 所有函数都接受 "YYYY-MM-DD" 字符串 (或其数组)，内部用 numpy 的工作日函数一次算完
+import os
+import numpy as np
+
+HOLIDAY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "trade_holidays.txt")
+
+def load_holidays(path=HOLIDAY_FILE):
+    days = []
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.split("#")[0].strip()
+                if line: days.append(line)
+    except FileNotFoundError: pass
+    return np.array(days, dtype="datetime64[D]")
+
+HOLIDAYS = load_holidays()
+CALENDAR = np.busdaycalendar(holidays=HOLIDAYS)
+
+def _days(x):
+    return np.asarray(x, dtype="datetime64[D]")
+
+# 是否交易日
+def is_trading_day(day):
+    return np.is_busday(_days(day), busdaycal=CALENDAR)
+
+# 最近一个交易日 (含当天)
+def last_trading_day(day):
+    d = np.busday_offset(_days(day), 0, roll="backward", busdaycal=CALENDAR)
+    return str(d)
+
+# (start, end] 之间的交易日个数；start 可以是数组，一次算出所有定投计划
+def count_trading_days(start, end):
+    n = np.busday_count(_days(start) + 1, _days(end) + 1, busdaycal=CALENDAR)
+    return np.maximum(n, 0)
+
+# (start, end] 之间的每一个交易日，返回字符串列表
+def trading_days_between(start, end):
+    s, e = _days(start) + 1, _days(end) + 1
+    if s >= e: return []
+    days = np.arange(s, e, dtype="datetime64[D]")
+    return [str(d) for d in days[np.is_busday(days, busdaycal=CALENDAR)]]
+
+# 是否在连续竞价时段 (交易日 9:30-11:30, 13:00-15:00)，hhmm 形如 "10:05"
+def is_trading_session(day, hhmm):
+    if not is_trading_day(day): return False
+    return "09:30" <= hhmm <= "11:30" or "13:00" <= hhmm <= "15:00"